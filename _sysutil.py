@@ -0,0 +1,117 @@
+""" Thread pool and C library helpers shared by path, metrics and
+downloadstats; not part of any of their interfaces.
+
+Pool runs calls on a fixed number of threads:
+
+from _sysutil import Pool
+with Pool(4) as pool:
+    futures = [pool.submit(os.stat, f) for f in files]
+    sizes = [f.result().st_size for f in futures]
+
+libc() is the C library through ctypes on Linux, or None elsewhere;
+libc_function() looks up one of its functions with its signature.
+
+threading, Queue and ctypes are imported where used.
+"""
+
+import sys
+
+__all__ = ["Future", "Pool", "libc", "libc_function"]
+
+class Future(object):
+    """ The eventual result of a call submitted to a Pool. """
+    def __init__(self):
+        import threading
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def result(self):
+        """ Wait for the call; re-raises its exception. """
+        self.event.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+class Pool(object):
+    """ A fixed number of threads running the calls submitted to them.
+
+    Suited to work that is mostly system calls or network I/O, which
+    run outside the interpreter lock.
+    """
+    def __init__(self, workers):
+        import threading, Queue
+        self.queue = Queue.Queue()
+        self.threads = []
+        for i in range(max(1, workers)):
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            future, fn, args = job
+            try:
+                future.value = fn(*args)
+            except:
+                future.exc_info = sys.exc_info()
+            future.event.set()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.queue.put((future, fn, args))
+        return future
+
+    def close(self, cancel=False):
+        """ Finish the submitted calls, then stop the threads.
+
+        With cancel, calls not started yet are dropped instead.
+        """
+        if cancel:
+            import Queue
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except Queue.Empty:
+                pass
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+
+_libc_handle = None
+
+def libc():
+    """ The C library through ctypes on Linux, or None; loaded on
+    first use. """
+    global _libc_handle
+    if _libc_handle is None:
+        # set only once resolved, as other threads may ask meanwhile
+        handle = False
+        if sys.platform.startswith('linux'):
+            try:
+                import ctypes
+                handle = ctypes.CDLL(None, use_errno=True)
+            except (ImportError, OSError):
+                pass
+        _libc_handle = handle
+    return _libc_handle or None
+
+def libc_function(name, restype, *argtypes):
+    """ The C library function name with the given signature, or None
+    where it is missing. """
+    fn = getattr(libc(), name, None)
+    if fn is not None:
+        fn.restype = restype
+        fn.argtypes = argtypes
+    return fn
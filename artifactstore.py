@@ -0,0 +1,156 @@
+""" A local content-addressed store of built nightlies.
+
+Every built XPI and its rendered update-nightly.rdf are kept by their
+SHA-256, with a small index mapping each version to its files, so a
+nightly can be republished, or rolled back to, without rebuilding.
+
+Layout of the root directory:
+
+  objects/AB/ABCDEF...  - the files, named by their SHA-256
+  index.json            - version -> {"xpi", "xpi_name", "rdf", "created"}
+
+Example:
+
+from artifactstore import ArtifactStore
+store = ArtifactStore("~/.nightly-store", max_bytes=1 << 30)
+entry = store.get("latest")
+print store.path(entry["xpi"])
+"""
+
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+__all__ = ["ArtifactStore", "StoreException"]
+
+class StoreException(Exception):
+    pass
+
+class ArtifactStore(object):
+    chunk_size = 1 << 16
+
+    def __init__(self, root, max_bytes=None):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.max_bytes = max_bytes
+        self.objects = os.path.join(self.root, "objects")
+        self.index_file = os.path.join(self.root, "index.json")
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(self.objects)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def path(self, hash):
+        return os.path.join(self.objects, hash[:2], hash)
+
+    def put(self, file_obj):
+        """ Store the rest of file_obj; returns its hash. """
+        sha = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(prefix=".incoming", dir=self.objects)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while True:
+                    chunk = file_obj.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    out.write(chunk)
+            hash = sha.hexdigest()
+            target = self.path(hash)
+            if os.path.exists(target):
+                os.unlink(tmp)
+            else:
+                try:
+                    os.mkdir(os.path.dirname(target))
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                os.rename(tmp, target)
+            tmp = None
+            return hash
+        finally:
+            if tmp is not None:
+                os.unlink(tmp)
+
+    def _read_index(self):
+        try:
+            with open(self.index_file, "rb") as fp:
+                return json.load(fp)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+
+    def _write_index(self, index):
+        fd, tmp = tempfile.mkstemp(prefix=".index", dir=self.root)
+        with os.fdopen(fd, "wb") as fp:
+            json.dump(index, fp, indent=1, sort_keys=True)
+        os.rename(tmp, self.index_file)
+
+    def record(self, version, xpi_name, xpi_hash, rdf_hash):
+        """ Index a version, then evict old ones beyond max_bytes. """
+        with self.lock:
+            index = self._read_index()
+            index[version] = {"xpi": xpi_hash,
+                              "xpi_name": xpi_name,
+                              "rdf": rdf_hash,
+                              "created": time.time()
+                              }
+            if self.max_bytes is not None:
+                self._evict(index, self.max_bytes, keep=version)
+            self._write_index(index)
+
+    def versions(self):
+        """ All stored versions, newest first. """
+        index = self._read_index()
+        return sorted(index, key=lambda v: index[v]["created"], reverse=True)
+
+    def get(self, version):
+        """ The entry of version; 'latest' and 'previous' are understood. """
+        index = self._read_index()
+        if version in ("latest", "previous"):
+            versions = self.versions()
+            pos = version == "previous" and 1 or 0
+            if len(versions) <= pos:
+                raise StoreException("no %s version stored" % version)
+            version = versions[pos]
+        try:
+            return dict(index[version], version=version)
+        except KeyError:
+            raise StoreException("version not stored: %s" % version)
+
+    def _size(self, hash):
+        try:
+            return os.stat(self.path(hash)).st_size
+        except OSError:
+            return 0
+
+    def _evict(self, index, max_bytes, keep=None):
+        by_age = sorted(index, key=lambda v: index[v]["created"])
+        total = sum(self._size(h) for h in self._referenced(index))
+        while total > max_bytes and by_age:
+            version = by_age.pop(0)
+            if version == keep:
+                continue
+            del index[version]
+            total = sum(self._size(h) for h in self._referenced(index))
+        live = self._referenced(index)
+        for d in os.listdir(self.objects):
+            sub = os.path.join(self.objects, d)
+            if not os.path.isdir(sub):
+                continue
+            for hash in os.listdir(sub):
+                if hash not in live:
+                    os.unlink(os.path.join(sub, hash))
+
+    def _referenced(self, index):
+        live = set()
+        for e in index.values():
+            live.add(e["xpi"])
+            live.add(e["rdf"])
+        return live
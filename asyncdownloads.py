@@ -0,0 +1,301 @@
+""" Non-blocking counterpart to githubdownloads.Downloads.
+
+Every operation of AsyncDownloads returns a Future right away.  The
+work is done by a small, bounded pool of worker threads, each keeping
+persistent HTTP connections to the API and S3 hosts, so hundreds of
+queued list, delete and upload calls share a handful of threads and
+connections.  Uploads stream from disk like Downloads.upload does.
+
+Example:
+
+from asyncdownloads import AsyncDownloads
+with AsyncDownloads("owner/repo", "user", "pass", concurrency=4) as d:
+    futures = [d.upload(f, replace=True) for f in files]
+    for f in futures:
+        print f.result()
+"""
+
+import base64
+import httplib
+import json
+import os
+import socket
+import sys
+import threading
+import urllib2
+import urlparse
+
+from io import BytesIO
+from Queue import Queue
+
+from githubdownloads import (GITHUB_API, DownloadInfo, DownloadsException,
+                             S3Multipart, parse_links, remaining_size)
+from metrics import NullMetrics
+
+__all__ = ["AsyncDownloads", "Future"]
+
+class Future(object):
+    """ The eventual result of an AsyncDownloads operation. """
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        """ Wait for the result; re-raises the operation's exception. """
+        if not self.event.wait(timeout):
+            raise DownloadsException("Timed out waiting for the result")
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+    def add_done_callback(self, fn):
+        """ Call fn(future) once done, on the thread that finishes it.
+
+        An exception from fn is printed to stderr and otherwise ignored
+        when a worker calls it, so it cannot take the worker down.
+        """
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, value=None, exc_info=None):
+        with self.lock:
+            self.value = value
+            self.exc_info = exc_info
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
+class _Worker(threading.Thread):
+    def __init__(self, owner, index):
+        threading.Thread.__init__(self, name="asyncdownloads-%d" % index)
+        self.daemon = True
+        self.owner = owner
+        self.connections = {}
+
+    def run(self):
+        owner = self.owner
+        owner.local.worker = self
+        while True:
+            job = owner.queue.get()
+            if job is None:
+                break
+            future, fn, args = job
+            try:
+                value = fn(*args)
+            except:
+                future._finish(exc_info=sys.exc_info())
+            else:
+                future._finish(value)
+        for conn in self.connections.values():
+            conn.close()
+
+    def connection(self, scheme, netloc, fresh=False):
+        key = (scheme, netloc)
+        conn = self.connections.get(key)
+        if conn is not None and fresh:
+            conn.close()
+            conn = None
+        if conn is None:
+            if scheme == "https":
+                conn = httplib.HTTPSConnection(netloc,
+                                               timeout=self.owner.timeout)
+            else:
+                conn = httplib.HTTPConnection(netloc,
+                                              timeout=self.owner.timeout)
+            self.connections[key] = conn
+            self.owner.metrics.count("connections")
+        return conn
+
+class AsyncDownloads(object):
+    def __init__(self, repo, user, password, concurrency=8, metrics=None,
+                 api=GITHUB_API, timeout=60):
+        self.repo = repo
+        self.user = user
+        self.password = password
+        self.concurrency = concurrency
+        self.metrics = metrics or NullMetrics()
+        self.timeout = timeout
+
+        self.api = "%s/repos/%s/downloads" % (api.rstrip("/"), repo)
+
+        raw = "%s:%s" % (user, password)
+        self.auth = 'Basic %s' % base64.b64encode(raw).strip()
+
+        self.queue = Queue()
+        self.local = threading.local()
+        self.workers = []
+        self.started = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        """ Finish all queued operations, then stop the workers. """
+        with self.lock:
+            workers, self.workers = self.workers, []
+        for w in workers:
+            self.queue.put(None)
+        for w in workers:
+            w.join()
+
+    def _submit(self, fn, *args):
+        with self.lock:
+            # replace workers that died, or queued jobs would wait forever
+            self.workers = [w for w in self.workers if w.is_alive()]
+            if len(self.workers) < self.concurrency:
+                w = _Worker(self, self.started)
+                self.started += 1
+                self.workers.append(w)
+                w.start()
+        future = Future()
+        self.queue.put((future, fn, args))
+        return future
+
+    # --- HTTP on the calling worker's persistent connections
+
+    def _http(self, method, url, body=None, headers=None, endpoint=None):
+        """ Perform one request and return (status, headers, data).
+
+        Raises urllib2.HTTPError for error statuses, like Downloads.
+        A reused connection the server has closed in the meantime is
+        retried once on a fresh one, unless a body was being streamed.
+        """
+        u = urlparse.urlsplit(url)
+        target = u.path + (u.query and "?" + u.query or "")
+        worker = self.local.worker
+        fresh = False
+        while True:
+            conn = worker.connection(u.scheme, u.netloc, fresh)
+            reused = not fresh and conn.sock is not None
+            try:
+                with self.metrics.request(endpoint or method):
+                    conn.request(method, target, body, headers or {})
+                    resp = conn.getresponse()
+                    data = resp.read()
+                break
+            except (httplib.BadStatusLine, httplib.CannotSendRequest,
+                    socket.error):
+                conn.close()
+                if not reused or hasattr(body, "read"):
+                    raise
+                fresh = True
+        if resp.will_close:
+            conn.close()
+        if resp.status >= 400:
+            raise urllib2.HTTPError(url, resp.status, resp.reason, resp.msg,
+                                    BytesIO(data))
+        return resp.status, resp.msg, data
+
+    def _api(self, method, additional_path="", data=None, url=None):
+        headers = {"Authorization": self.auth}
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+            self.metrics.count("bytes_sent", len(data))
+        endpoint = "%s downloads%s" % (method, additional_path and "/:id" or "")
+        return self._http(method, (url or self.api) + additional_path, data,
+                          headers, endpoint)
+
+    # --- Operations; each returns a Future
+
+    def list(self):
+        return self._submit(self._list)
+
+    def _list(self):
+        return list(self._iter_list())
+
+    def _iter_list(self, per_page=100):
+        url = "%s?per_page=%d" % (self.api, per_page)
+        while url:
+            status, headers, data = self._api("GET", url=url)
+            url = parse_links(headers.getheader("Link")).get("next")
+            for i in json.loads(data):
+                yield DownloadInfo(self, i)
+
+    def delete(self, id_or_name):
+        return self._submit(self._delete, id_or_name)
+
+    def _delete(self, id_or_name):
+        if not isinstance(id_or_name, int):
+            id_or_name = self._get_info_by_name(id_or_name).id
+        self._api("DELETE", "/%d" % id_or_name)
+
+    def get_info_by_name(self, name):
+        return self._submit(self._get_info_by_name, name)
+
+    def _get_info_by_name(self, name):
+        for d in self._iter_list():
+            if d.name == name:
+                return d
+        raise DownloadsException("no download with that name")
+
+    def upload(self, file_or_name, file_name=None, mime=None, replace=False,
+               progress=None):
+        """ Create the download and stream its data to S3.
+
+        Same arguments as Downloads.upload; the Future yields the
+        DownloadInfo.
+        """
+        return self._submit(self._upload, file_or_name, file_name, mime,
+                            replace, progress)
+
+    def _upload(self, file_or_name, file_name, mime, replace, progress):
+        if isinstance(file_or_name, basestring):
+            size = os.stat(file_or_name).st_size
+            file_name = file_name or os.path.basename(file_or_name)
+            fo = open(file_or_name, "rb")
+        else:
+            size = remaining_size(file_or_name)
+            fo = file_or_name
+        if not file_name:
+            raise DownloadsException("Must provide a file name")
+        try:
+            j = {"name": file_name,
+                 "size": size
+                 }
+            if mime:
+                j["content_type"] = mime
+            j = json.dumps(j)
+            try:
+                status, headers, data = self._api("POST", data=j)
+            except urllib2.HTTPError, ex:
+                if not replace:
+                    raise
+                for e in json.load(ex)["errors"]:
+                    if e["code"] == "already_exists":
+                        break
+                else:
+                    raise
+                self._delete(file_name)
+                status, headers, data = self._api("POST", data=j)
+
+            j = json.loads(data)
+            body = S3Multipart(j, fo, size, progress=progress)
+            self.metrics.count("bytes_sent", len(body))
+            self._http("POST", j["s3_url"], body,
+                       {"Content-Type": ("multipart/form-data; boundary=%s"
+                                         % S3Multipart.boundary),
+                        "Content-Length": str(len(body))
+                        },
+                       "POST s3")
+            return DownloadInfo(self, j)
+        finally:
+            if fo is not file_or_name:
+                fo.close()
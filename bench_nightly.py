@@ -0,0 +1,253 @@
+""" End-to-end benchmark of the nightly pipeline.
+
+Generates synthetic extension trees, publishes each through
+nightly.publish against a local fakegithub server, and records the
+per-stage wall time, throughput and peak RSS of every case.  Each case
+runs in a fresh interpreter so peak RSS is its own.
+
+Cases are named SIZE-SHAPE-CONTENT:
+  SIZE    - small, medium or huge
+  SHAPE   - tiny (many small files) or assets (a few large ones)
+  CONTENT - text (compressible) or random (incompressible)
+
+Example:
+
+python bench_nightly.py --save baseline.json
+python bench_nightly.py --baseline baseline.json --threshold 0.15
+
+The second run exits with status 1 if any case or stage got slower
+than the baseline by more than the threshold, or any case's peak RSS
+grew by more than the RSS threshold.
+"""
+
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from path import path
+
+SIZES = {
+    # size: (tiny file count, asset count, asset bytes)
+    "small": (50, 2, 1 << 20),
+    "medium": (500, 4, 8 << 20),
+    "huge": (5000, 4, 64 << 20),
+    }
+SHAPES = ["tiny", "assets"]
+CONTENTS = ["text", "random"]
+
+INSTALL_RDF = """<?xml version="1.0"?>
+<RDF xmlns="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+     xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+  <Description about="urn:mozilla:install-manifest">
+    <em:id>bench@example.com</em:id>
+    <em:version>1.0</em:version>
+    <em:targetApplication>
+      <Description>
+        <em:id>{ec8030f7-c20a-464f-9b0e-13a3a9e97384}</em:id>
+        <em:minVersion>10.0</em:minVersion>
+        <em:maxVersion>20.*</em:maxVersion>
+      </Description>
+    </em:targetApplication>
+  </Description>
+</RDF>
+"""
+
+WORDS = ("function var return this prototype window document "
+         "addEventListener null true false if else for").split()
+
+def all_cases(sizes=None):
+    return ["%s-%s-%s" % (s, sh, c)
+            for s in (sizes or ["small", "medium", "huge"])
+            for sh in SHAPES
+            for c in CONTENTS]
+
+def _content(kind, size, rnd):
+    if kind == "random":
+        return os.urandom(size)
+    words = []
+    length = 0
+    while length < size:
+        w = rnd.choice(WORDS)
+        words.append(w)
+        length += len(w) + 1
+    return " ".join(words)[:size]
+
+def generate(case, root):
+    """ Create the synthetic tree of case below root, once. """
+    root = path(root)
+    marker = root / ".complete"
+    if marker.exists():
+        return root
+    if root.exists():
+        root.rmtree()
+    size, shape, content = case.split("-")
+    tiny, assets, asset_size = SIZES[size]
+    rnd = random.Random(case)
+    root.makedirs()
+    (root / "install.rdf").write_bytes(INSTALL_RDF)
+    (root / "chrome.manifest").write_bytes("content bench chrome/content/\n")
+    if shape == "tiny":
+        for i in range(tiny):
+            d = root / "chrome" / "content" / ("d%02d" % (i % 37))
+            d.makedirs_p()
+            (d / ("f%05d.js" % i)).write_bytes(
+                _content(content, rnd.randint(200, 4000), rnd))
+    else:
+        d = root / "chrome" / "content"
+        d.makedirs_p()
+        for i in range(assets):
+            (d / ("asset%d.bin" % i)).write_bytes(
+                _content(content, asset_size, rnd))
+    marker.touch()
+    return root
+
+def run_case(case, workdir, latency=0.0, bandwidth=None):
+    """ Publish case once in this process and return its results. """
+    import nightly
+    from fakegithub import FakeGitHub
+    from metrics import Metrics
+
+    tree = generate(case, path(workdir) / case)
+    with FakeGitHub(latency=latency, bandwidth=bandwidth) as gh:
+        config = {"user": "bench",
+                  "pass": "bench",
+                  "repo": "bench/bench",
+                  "extension": "bench",
+                  "dirname": tree,
+                  "hashalgo": "sha256",
+                  "api": gh.url
+                  }
+        for k in nightly.CKEYS:
+            config.setdefault(k, None)
+        metrics = Metrics()
+        with metrics.stage("total"):
+            nightly.publish(path(nightly.__file__).dirname(), config, metrics)
+    d = metrics.to_dict()
+    wall = d["stages"]["total"]["wall"]
+    return {"wall": wall,
+            "stages": dict((k, v["wall"]) for k, v in d["stages"].items()),
+            "bytes_read": d["counters"].get("bytes_read", 0),
+            "throughput": d["counters"].get("bytes_read", 0) / wall,
+            "peak_rss": d["peak_rss"]
+            }
+
+def run(cases, workdir, repeat=1, latency=0.0, bandwidth=None):
+    """ Run every case in a subprocess; keep the fastest of repeat runs. """
+    results = {}
+    for case in cases:
+        best = None
+        for i in range(repeat):
+            args = [sys.executable, os.path.abspath(__file__),
+                    "--case", case, "--workdir", workdir,
+                    "--latency", str(latency)]
+            if bandwidth:
+                args += ["--bandwidth", str(bandwidth)]
+            r = json.loads(subprocess.check_output(args))
+            if best is None or r["wall"] < best["wall"]:
+                best = r
+        results[case] = best
+        print >>sys.stderr, "%-22s %8.3fs %8.1f MB/s %8.1f MB RSS" % (
+            case, best["wall"], best["throughput"] / (1 << 20),
+            (best["peak_rss"] or 0) / float(1 << 20))
+    return results
+
+# growths of peak RSS below this many bytes are never regressions
+RSS_NOISE = 1 << 20
+
+def compare(results, baseline, threshold, noise=0.01, rss_threshold=0.1):
+    """ Return (case, stage, old, new) for every regression.
+
+    Slowdowns of less than noise seconds are never regressions, which
+    keeps sub-millisecond stages from flapping.  Peak RSS is compared
+    with rss_threshold, as stage "peak_rss"; it is skipped where either
+    run could not measure it.
+    """
+    regressions = []
+    for case, r in sorted(results.items()):
+        b = baseline.get(case)
+        if not b:
+            continue
+        pairs = [("total", b["wall"], r["wall"])]
+        for stage, old in sorted(b["stages"].items()):
+            if stage != "total" and stage in r["stages"]:
+                pairs.append((stage, old, r["stages"][stage]))
+        for stage, old, new in pairs:
+            if new > old * (1 + threshold) and new - old >= noise:
+                regressions.append((case, stage, old, new))
+        old, new = b.get("peak_rss"), r.get("peak_rss")
+        if (old and new and new > old * (1 + rss_threshold)
+                and new - old >= RSS_NOISE):
+            regressions.append((case, "peak_rss", old, new))
+    return regressions
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("--sizes", default="small,medium",
+                      help="Comma separated sizes to run (small, medium, huge)")
+    parser.add_option("--cases",
+                      help="Comma separated case names, overrides --sizes")
+    parser.add_option("--workdir",
+                      help="Where to keep generated trees (default: a temp dir)")
+    parser.add_option("--repeat", type="int", default=3)
+    parser.add_option("--latency", type="float", default=0.0,
+                      help="Fake API latency in seconds")
+    parser.add_option("--bandwidth", type="int",
+                      help="Fake API bandwidth in bytes per second")
+    parser.add_option("--save", help="Write results to this file")
+    parser.add_option("--baseline", help="Compare against this results file")
+    parser.add_option("--threshold", type="float", default=0.1,
+                      help="Allowed slowdown against the baseline (0.1 = 10%)")
+    parser.add_option("--noise", type="float", default=0.01,
+                      help="Ignore slowdowns below this many seconds")
+    parser.add_option("--rss-threshold", type="float", default=0.1,
+                      help="Allowed peak RSS growth against the baseline")
+    parser.add_option("--case", help="Run a single case in-process (internal)")
+
+    opts, args = parser.parse_args()
+
+    if opts.case:
+        json.dump(run_case(opts.case, opts.workdir, opts.latency, opts.bandwidth),
+                  sys.stdout)
+        return 0
+
+    if opts.cases:
+        cases = opts.cases.split(",")
+    else:
+        cases = all_cases(opts.sizes.split(","))
+    workdir = opts.workdir or tempfile.mkdtemp(prefix="bench-nightly-")
+    try:
+        results = run(cases, workdir, opts.repeat, opts.latency, opts.bandwidth)
+    finally:
+        if not opts.workdir:
+            shutil.rmtree(workdir)
+
+    if opts.save:
+        with open(opts.save, "wb") as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    if opts.baseline:
+        with open(opts.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, opts.threshold, opts.noise,
+                              opts.rss_threshold)
+        for case, stage, old, new in regressions:
+            if stage == "peak_rss":
+                change = "%.1f MB -> %.1f MB" % (old / float(1 << 20),
+                                                 new / float(1 << 20))
+            else:
+                change = "%.3fs -> %.3fs" % (old, new)
+            if old:
+                change += " (%+.0f%%)" % ((new / float(old) - 1) * 100)
+            print "REGRESSION %s %s: %s" % (case, stage, change)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
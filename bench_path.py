@@ -0,0 +1,219 @@
+""" Microbenchmarks of path.py against plain os/os.path.
+
+Builds a synthetic tree and times each path primitive next to the
+os/os.path code it wraps, reporting the overhead as a ratio.
+
+Example:
+
+python bench_path.py --dirs 200 --files 50
+python bench_path.py --only walk,listdir --json results.json
+"""
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from path import path
+
+def make_tree(root, dirs, files, depth=3):
+    """ Spread dirs directories over depth levels with files files each. """
+    root = path(root)
+    made = [root]
+    i = 0
+    while len(made) <= dirs:
+        parent = made[i % len(made)]
+        if len(parent.splitall()) - len(root.splitall()) >= depth:
+            parent = root
+        d = parent / ("d%04d" % len(made))
+        d.mkdir()
+        made.append(d)
+        i += 1
+    line = "var x = function() { return this.value; };\n"
+    for d in made:
+        for j in range(files):
+            (d / ("f%03d.js" % j)).write_bytes(line * (1 + j % 64))
+    return root
+
+def _os_walk(top):
+    rv = []
+    for dirpath, dirnames, filenames in os.walk(top):
+        rv.extend(os.path.join(dirpath, n) for n in dirnames)
+        rv.extend(os.path.join(dirpath, n) for n in filenames)
+    return rv
+
+def _os_walkfiles(top):
+    rv = []
+    for dirpath, dirnames, filenames in os.walk(top):
+        rv.extend(os.path.join(dirpath, n) for n in filenames)
+    return rv
+
+def _os_hash(name):
+    m = hashlib.md5()
+    with open(name, "rb") as f:
+        while True:
+            d = f.read(8192)
+            if not d:
+                break
+            m.update(d)
+    return m.hexdigest()
+
+def _os_read(name, mode="r"):
+    with open(name, mode) as f:
+        return f.read()
+
+def _os_readlines(name):
+    with open(name, "rU") as f:
+        return f.readlines()
+
+def _os_splitall(p):
+    parts = []
+    while True:
+        head, tail = os.path.split(p)
+        if head == p:
+            parts.append(head)
+            break
+        if tail:
+            parts.append(tail)
+        if not head:
+            break
+        p = head
+    parts.reverse()
+    return parts
+
+def cases(root):
+    """ Yield (name, path callable, os callable) pairs over root. """
+    proot = path(root)
+    sroot = str(root)
+    pdirs = [d for d in proot.walkdirs()]
+    sdirs = [str(d) for d in pdirs]
+    pfiles = [f for f in proot.walkfiles()]
+    sfiles = [str(f) for f in pfiles]
+    sample = pfiles[::max(1, len(pfiles) // 500)]
+    ssample = [str(f) for f in sample]
+    names = [f.name for f in pfiles]
+
+    yield ("listdir",
+           lambda: [d.listdir() for d in pdirs],
+           lambda: [[os.path.join(d, n) for n in os.listdir(d)] for d in sdirs])
+    yield ("walk",
+           lambda: list(proot.walk()),
+           lambda: _os_walk(sroot))
+    yield ("walkfiles",
+           lambda: list(proot.walkfiles()),
+           lambda: _os_walkfiles(sroot))
+    yield ("glob",
+           lambda: proot.glob("*/*.js"),
+           lambda: glob.glob(os.path.join(sroot, "*/*.js")))
+    yield ("isfile",
+           lambda: [f.isfile() for f in pfiles],
+           lambda: [os.path.isfile(f) for f in sfiles])
+    yield ("isdir",
+           lambda: [f.isdir() for f in pfiles],
+           lambda: [os.path.isdir(f) for f in sfiles])
+    yield ("exists",
+           lambda: [f.exists() for f in pfiles],
+           lambda: [os.path.exists(f) for f in sfiles])
+    yield ("size",
+           lambda: [f.size for f in pfiles],
+           lambda: [os.path.getsize(f) for f in sfiles])
+    yield ("hash",
+           lambda: [f.read_hexhash("md5") for f in sample],
+           lambda: [_os_hash(f) for f in ssample])
+    yield ("text",
+           lambda: [f.text() for f in sample],
+           lambda: [_os_read(f, "rU") for f in ssample])
+    yield ("text-unicode",
+           lambda: [f.text("utf-8") for f in sample],
+           lambda: [_os_read(f, "rb").decode("utf-8") for f in ssample])
+    yield ("lines",
+           lambda: [f.lines() for f in sample],
+           lambda: [_os_readlines(f) for f in ssample])
+    yield ("iterlines",
+           lambda: [list(f.iterlines()) for f in sample],
+           lambda: [_os_readlines(f) for f in ssample])
+    yield ("joinpath",
+           lambda: [proot.joinpath("a", n) for n in names],
+           lambda: [os.path.join(sroot, "a", n) for n in names])
+    yield ("div",
+           lambda: [proot / n for n in names],
+           lambda: [os.path.join(sroot, n) for n in names])
+    yield ("name+parent",
+           lambda: [(f.name, f.parent) for f in pfiles],
+           lambda: [(os.path.basename(f), os.path.dirname(f)) for f in sfiles])
+    yield ("splitall",
+           lambda: [f.splitall() for f in pfiles],
+           lambda: [_os_splitall(f) for f in sfiles])
+    yield ("relpathto",
+           lambda: [proot.relpathto(f) for f in sample],
+           lambda: [os.path.relpath(f, sroot) for f in ssample])
+
+def best_of(fn, repeat):
+    best = None
+    for i in range(repeat):
+        started = time.time()
+        fn()
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def run(root, repeat=5, only=None):
+    results = {}
+    for name, pfn, ofn in cases(root):
+        if only and name not in only:
+            continue
+        # warm the caches once for both
+        pfn()
+        ofn()
+        results[name] = {"path": best_of(pfn, repeat),
+                         "os": best_of(ofn, repeat)}
+    return results
+
+def report(results, out=sys.stdout):
+    print >>out, "%-14s %10s %10s %8s" % ("operation", "path", "os", "ratio")
+    for name, r in sorted(results.items()):
+        ratio = r["os"] and r["path"] / r["os"] or float("nan")
+        print >>out, "%-14s %9.2fms %9.2fms %7.2fx" % (
+            name, r["path"] * 1000, r["os"] * 1000, ratio)
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("--dirs", type="int", default=100)
+    parser.add_option("--files", type="int", default=50,
+                      help="Files per directory")
+    parser.add_option("--depth", type="int", default=3)
+    parser.add_option("--repeat", type="int", default=5)
+    parser.add_option("--only", help="Comma separated operations to run")
+    parser.add_option("--tree", help="Benchmark this existing tree instead")
+    parser.add_option("--json", help="Also write results to this file")
+
+    opts, args = parser.parse_args()
+    only = opts.only and opts.only.split(",") or None
+
+    tmp = None
+    if opts.tree:
+        root = path(opts.tree)
+    else:
+        tmp = tempfile.mkdtemp(prefix="bench-path-")
+        root = make_tree(tmp, opts.dirs, opts.files, opts.depth)
+    try:
+        results = run(root, opts.repeat, only)
+    finally:
+        if tmp:
+            shutil.rmtree(tmp)
+
+    report(results)
+    if opts.json:
+        with open(opts.json, "wb") as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
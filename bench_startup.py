@@ -0,0 +1,142 @@
+""" Cold startup budget of the nightly entry points.
+
+Byte-compiles the modules first, then times a fresh interpreter
+importing each module against a bare one, keeping the best time of
+several runs, and checks the difference against a budget in
+milliseconds.  It also
+checks that importing nightly, and a --dry-run build of a small
+synthetic tree, never load the network stack.
+
+Example:
+
+python bench_startup.py
+python bench_startup.py --budget nightly=20 --repeat 10 --json startup.json
+
+Exits with status 1 if a module is over budget or a network module
+got loaded.
+"""
+
+import compileall
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# module: milliseconds, on top of the bare interpreter
+BUDGETS = {
+    "path": 5.0,
+    "nightly": 25.0,
+    "githubdownloads": 30.0,
+    }
+
+NETWORK_MODULES = ["socket", "ssl", "httplib", "urllib", "urllib2",
+                   "githubdownloads", "asyncdownloads"]
+
+BARE = "import sys; sys.path.insert(0, %r)"
+
+LOADED = """
+import sys
+sys.path.insert(0, %r)
+sys.argv = ["nightly.py"] + %r
+import nightly
+if len(sys.argv) > 1:
+    import optparse
+    nightly.optparse = optparse
+    nightly.main()
+print " ".join(m for m in %r if sys.modules.get(m) is not None)
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def _python(code):
+    return subprocess.check_output([sys.executable, "-c", code]).splitlines()
+
+def startup_time(code, repeat):
+    """ Best wall time of repeat fresh interpreters running code, in
+    milliseconds. """
+    best = None
+    for i in range(repeat):
+        started = time.time()
+        subprocess.check_call([sys.executable, "-c", code])
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1000
+
+def import_time(module, repeat, bare):
+    """ Best time of repeat cold imports of module in milliseconds, less
+    bare, the startup time of the interpreter alone. """
+    code = BARE % HERE + "; import %s" % module
+    return max(0.0, startup_time(code, repeat) - bare)
+
+def network_modules(args=()):
+    """ The network modules loaded by running nightly with args. """
+    return _python(LOADED % (HERE, list(args), NETWORK_MODULES))[-1].split()
+
+def dry_run_modules(workdir):
+    """ The network modules loaded by a --dry-run of a small tree. """
+    from bench_nightly import generate
+
+    tree = generate("small-tiny-text", os.path.join(workdir, "tree"))
+    config = os.path.join(workdir, "config.ini")
+    with open(config, "wb") as fp:
+        fp.write("[github]\n"
+                 "extension = bench\n"
+                 "dirname = %s\n"
+                 "hashalgo = sha256\n"
+                 "repo = bench/bench\n" % tree)
+    return network_modules([config, "--dry-run"])
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("--repeat", type="int", default=5)
+    parser.add_option("--budget", action="append", default=[],
+                      metavar="MODULE=MS",
+                      help="Override or add the budget of a module")
+    parser.add_option("--json", help="Also write results to this file")
+
+    opts, args = parser.parse_args()
+    budgets = dict(BUDGETS)
+    for b in opts.budget:
+        module, ms = b.split("=", 1)
+        budgets[module] = float(ms)
+
+    # time what a deployed checkout runs, not the compiler
+    compileall.compile_dir(HERE, maxlevels=0, quiet=1)
+    bare = startup_time(BARE % HERE, opts.repeat)
+    print "%-16s %7.2fms" % ("(interpreter)", bare)
+
+    failed = False
+    results = {"bare_ms": bare, "import_ms": {}, "network_modules": {}}
+    for module, budget in sorted(budgets.items()):
+        ms = import_time(module, opts.repeat, bare)
+        results["import_ms"][module] = ms
+        over = ms > budget
+        failed = failed or over
+        print "%-16s %7.2fms  budget %7.2fms%s" % (
+            module, ms, budget, over and "  OVER BUDGET" or "")
+
+    workdir = tempfile.mkdtemp(prefix="bench-startup-")
+    try:
+        checks = [("import nightly", network_modules()),
+                  ("nightly --dry-run", dry_run_modules(workdir))]
+    finally:
+        shutil.rmtree(workdir)
+    for name, loaded in checks:
+        results["network_modules"][name] = loaded
+        failed = failed or bool(loaded)
+        print "%-18s loads %s" % (name, loaded and " ".join(loaded)
+                                  or "no network modules")
+
+    if opts.json:
+        with open(opts.json, "wb") as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    return failed and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main())
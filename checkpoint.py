@@ -0,0 +1,161 @@
+""" Checkpoints of a nightly run, so that a failed run can be resumed.
+
+A publish goes through stages: build the XPI, clean up old nightlies,
+reserve the XPI download and send it, render update.rdf, reserve and
+send that.  With a checkpoint directory, every stage that finishes is
+recorded there along with what it produced, and a rerun starts at the
+first stage that did not finish: the XPI is not built again, and the
+download created for it is filled in rather than created anew.
+
+Layout of the directory:
+
+  state.json  - the run key, the finished stages and the SHA-256 of
+                every file below
+  NAME        - the files the stages produced
+  tree.snap   - a snapshot of the source tree the XPI was built from
+
+A checkpoint is only resumed by a run with the same key (the
+configuration) over an unchanged source tree, and only if its files
+are intact; otherwise the run starts over.  clear() removes it once
+everything is published.  Only the files listed above are ever
+removed, never the directory itself.
+
+Example:
+
+from checkpoint import Checkpoint
+cp = Checkpoint("~/.nightly-checkpoint", key)
+if not cp.get("built"):
+    cp.commit({"nightly.xpi": data}, built=True)
+"""
+
+import errno
+import hashlib
+import json
+import struct
+from io import BytesIO
+
+from path import path, GroupCommit, TreeSnapshot, diff
+
+__all__ = ["Checkpoint", "NullCheckpoint"]
+
+STATE = "state.json"
+TREE = "tree.snap"
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def _data(f):
+    if isinstance(f, bytes):
+        return f
+    return f.getvalue()
+
+class NullCheckpoint(object):
+    """ The state of a run that is not checkpointed, kept in memory. """
+    def __init__(self):
+        self.state = {}
+        self.files = {}
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def commit(self, files=None, **state):
+        """ Record that a stage finished, with the files it produced:
+        their data, or in-memory file objects holding it.  File objects
+        are kept as they are, not copied. """
+        self.files.update(files or {})
+        self.state.update(state)
+
+    def read(self, name):
+        return _data(self.files[name])
+
+    def source(self, name):
+        """ What to upload the file name from; the file object it was
+        committed as, rewound, if any. """
+        f = self.files[name]
+        if isinstance(f, bytes):
+            return BytesIO(f)
+        f.seek(0)
+        return f
+
+    def put_tree(self, dirname):
+        pass
+
+    def tree_changed(self, dirname):
+        return True
+
+    def clear(self):
+        self.state = {}
+        self.files = {}
+
+class Checkpoint(NullCheckpoint):
+    def __init__(self, directory, key):
+        self.dir = path(directory).expanduser().abspath()
+        self.key = key
+        self.dir.makedirs_p()
+        self.state = self._load()
+
+    def _load(self):
+        try:
+            state = json.loads(self.dir.joinpath(STATE).bytes())
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+        except ValueError:
+            state = {}
+        if state.get("key") != self.key or not self._intact(state):
+            self._remove(state)
+            return {}
+        return state
+
+    def _intact(self, state):
+        for name, hash in state.get("files", {}).items():
+            try:
+                if _sha256(self.dir.joinpath(name).bytes()) != hash:
+                    return False
+            except IOError:
+                return False
+        return True
+
+    def commit(self, files=None, **state):
+        """ Write the files and the new state, durably and together. """
+        self.state.update(state, key=self.key)
+        hashes = self.state.setdefault("files", {})
+        with GroupCommit():
+            for name, data in (files or {}).items():
+                data = _data(data)
+                self.dir.joinpath(name).write_bytes(data, atomic=True)
+                hashes[name] = _sha256(data)
+            # renamed into place last
+            self.dir.joinpath(STATE).write_bytes(
+                json.dumps(self.state, indent=1, sort_keys=True), atomic=True)
+
+    def read(self, name):
+        return self.dir.joinpath(name).bytes()
+
+    def source(self, name):
+        return self.dir.joinpath(name)
+
+    def put_tree(self, dirname):
+        """ Snapshot dirname, before building from it. """
+        path(dirname).expanduser().snapshot().save(self.dir.joinpath(TREE))
+
+    def tree_changed(self, dirname):
+        """ Whether dirname changed since put_tree(), or cannot tell. """
+        try:
+            old = TreeSnapshot.load(self.dir.joinpath(TREE))
+        except (IOError, EOFError, ValueError, struct.error):
+            return True
+        new = path(dirname).expanduser().snapshot()
+        for change in diff(old, new):
+            return True
+        return False
+
+    def _remove(self, state):
+        # the state goes first, so a half removed checkpoint is never used
+        for name in [STATE] + sorted(state.get("files", {})) + [TREE]:
+            self.dir.joinpath(name).remove_p()
+
+    def clear(self):
+        self._remove(self.state)
+        self.state = {}
@@ -0,0 +1,316 @@
+""" Track the download counts of nightlies over time.
+
+Collector polls the download listings of many repositories with
+conditional requests, so pages that did not change cost neither
+bandwidth nor rate limit, and StatsStore records only the counters
+that changed.  The store is one SQLite file:
+
+  repos(repo, polled)                    - the repositories seen
+  downloads(id, repo, name, size, count) - the last recorded counter
+  samples(download, ts, count, delta)    - append-only; a row for every
+                                           change, with the downloads
+                                           since the previous one; none
+                                           while a download is at 0
+  pages(repo, url, etag, next_url)       - validators of listing pages
+
+The first poll of a repository records its counters as a baseline, with
+no downloads attributed to it.  A counter going down means the file was
+replaced; its new count is taken as downloads since then.
+
+Example:
+
+from downloadstats import Collector, StatsStore
+store = StatsStore("~/nightly-stats.sqlite")
+Collector(store, "user", "pass").poll(["owner/repo"])
+print store.total("owner/repo", start=time.time() - 7 * 86400)
+
+or from the command line:
+
+python downloadstats.py --db stats.sqlite -u user -p pass poll owner/repo
+python downloadstats.py --db stats.sqlite daily owner/repo --since 30
+"""
+
+import os
+import sqlite3
+import time
+
+from metrics import NullMetrics
+
+__all__ = ["Collector", "StatsStore"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS repos (
+    repo TEXT PRIMARY KEY,
+    polled INTEGER
+);
+CREATE TABLE IF NOT EXISTS downloads (
+    id INTEGER PRIMARY KEY,
+    repo TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER,
+    count INTEGER NOT NULL,
+    UNIQUE (repo, name)
+);
+CREATE TABLE IF NOT EXISTS samples (
+    download INTEGER NOT NULL REFERENCES downloads (id),
+    ts INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    delta INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_download_ts ON samples (download, ts);
+CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts);
+CREATE TABLE IF NOT EXISTS pages (
+    repo TEXT NOT NULL,
+    url TEXT NOT NULL,
+    etag TEXT,
+    next_url TEXT,
+    PRIMARY KEY (repo, url)
+);
+"""
+
+class StatsStore(object):
+    """ The SQLite store; use it from one thread at a time. """
+    def __init__(self, filename):
+        if filename != ":memory:":
+            filename = os.path.abspath(os.path.expanduser(filename))
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    # --- Recording
+
+    def pages(self, repo):
+        """ The known listing pages of repo, as Downloads.iter_pages()
+        takes them. """
+        return dict((url, (etag, next_url)) for url, etag, next_url in
+                    self.db.execute("SELECT url, etag, next_url FROM pages"
+                                    " WHERE repo = ?", (repo,)))
+
+    def record(self, repo, pages, now=None):
+        """ Record a pass over the listing of repo.
+
+        pages are (url, etag, next_url, downloads) as yielded by
+        Downloads.iter_pages(); only counters that changed are written.
+        Returns the number of samples written.
+        """
+        now = int(now or time.time())
+        written = 0
+        with self.db:
+            baseline = not self.db.execute(
+                "SELECT 1 FROM repos WHERE repo = ?", (repo,)).fetchone()
+            self.db.execute("DELETE FROM pages WHERE repo = ?", (repo,))
+            for url, etag, next_url, downloads in pages:
+                self.db.execute("INSERT INTO pages VALUES (?, ?, ?, ?)",
+                                (repo, url, etag, next_url))
+                for d in downloads or ():
+                    written += self._record(repo, d, now, baseline)
+            self.db.execute("INSERT OR REPLACE INTO repos VALUES (?, ?)",
+                            (repo, now))
+        return written
+
+    def _record(self, repo, d, now, baseline):
+        row = self.db.execute("SELECT id, count FROM downloads"
+                              " WHERE repo = ? AND name = ?",
+                              (repo, d.name)).fetchone()
+        count = getattr(d, "download_count", 0) or 0
+        if row is None:
+            id = self.db.execute("INSERT INTO downloads (repo, name, size, count)"
+                                 " VALUES (?, ?, ?, ?)",
+                                 (repo, d.name, getattr(d, "size", None),
+                                  count)).lastrowid
+            if not count:
+                return 0
+            delta = not baseline and count or 0
+        elif row[1] == count:
+            return 0
+        else:
+            id = row[0]
+            self.db.execute("UPDATE downloads SET count = ?, size = ?"
+                            " WHERE id = ?",
+                            (count, getattr(d, "size", None), id))
+            # gone down: a new file under the same name
+            delta = count >= row[1] and count - row[1] or count
+        self.db.execute("INSERT INTO samples VALUES (?, ?, ?, ?)",
+                        (id, now, count, delta))
+        return 1
+
+    # --- Queries; times are seconds since the epoch, start inclusive,
+    # end exclusive, and name patterns are GLOB patterns
+
+    def _where(self, repo, start, end, pattern):
+        sql = " WHERE d.repo = ?"
+        args = [repo]
+        if start is not None:
+            sql += " AND s.ts >= ?"
+            args.append(int(start))
+        if end is not None:
+            sql += " AND s.ts < ?"
+            args.append(int(end))
+        if pattern:
+            sql += " AND d.name GLOB ?"
+            args.append(pattern)
+        return sql, args
+
+    def total(self, repo, start=None, end=None, pattern=None):
+        """ Downloads of repo between start and end. """
+        where, args = self._where(repo, start, end, pattern)
+        return self.db.execute("SELECT COALESCE(SUM(s.delta), 0)"
+                               " FROM samples s JOIN downloads d"
+                               " ON s.download = d.id" + where,
+                               args).fetchone()[0]
+
+    def per_period(self, repo, period=86400, start=None, end=None,
+                   pattern=None):
+        """ [(period start, downloads)] of repo, for periods with any. """
+        where, args = self._where(repo, start, end, pattern)
+        return self.db.execute("SELECT s.ts - s.ts % ? AS p, SUM(s.delta)"
+                               " FROM samples s JOIN downloads d"
+                               " ON s.download = d.id" + where +
+                               " GROUP BY p HAVING SUM(s.delta) > 0"
+                               " ORDER BY p",
+                               [int(period)] + args).fetchall()
+
+    def top(self, repo, start=None, end=None, pattern=None, limit=10):
+        """ [(name, downloads)] of the most downloaded files of repo. """
+        where, args = self._where(repo, start, end, pattern)
+        return self.db.execute("SELECT d.name, SUM(s.delta) AS n"
+                               " FROM samples s JOIN downloads d"
+                               " ON s.download = d.id" + where +
+                               " GROUP BY d.id HAVING n > 0"
+                               " ORDER BY n DESC, d.name LIMIT ?",
+                               args + [limit]).fetchall()
+
+    def history(self, repo, name, start=None, end=None):
+        """ [(ts, count)] of every recorded change of a download. """
+        where, args = self._where(repo, start, end, None)
+        return self.db.execute("SELECT s.ts, s.count"
+                               " FROM samples s JOIN downloads d"
+                               " ON s.download = d.id" + where +
+                               " AND d.name = ? ORDER BY s.ts",
+                               args + [name]).fetchall()
+
+    def repos(self):
+        """ [(repo, last poll)] of every repository polled. """
+        return self.db.execute("SELECT repo, polled FROM repos"
+                               " ORDER BY repo").fetchall()
+
+class Collector(object):
+    """ Polls repositories into a StatsStore.
+
+    The listings are fetched on a pool of workers threads; the store is
+    only written from the calling thread.
+    """
+    def __init__(self, store, user, password, api=None, per_page=100,
+                 workers=4, metrics=None):
+        self.store = store
+        self.user = user
+        self.password = password
+        self.api = api
+        self.per_page = per_page
+        self.workers = workers
+        self.metrics = metrics or NullMetrics()
+
+    def _downloads(self, repo):
+        from githubdownloads import Downloads, GITHUB_API
+
+        return Downloads(repo, self.user, self.password,
+                         metrics=self.metrics, api=self.api or GITHUB_API)
+
+    def fetch(self, repo, known):
+        """ The pages of repo's listing, with unchanged ones left out. """
+        return list(self._downloads(repo).iter_pages(known, self.per_page))
+
+    def poll(self, repos, now=None):
+        """ Poll every repo once; returns {repo: samples written}. """
+        from _sysutil import Pool
+
+        pool = Pool(self.workers)
+        cancel = True
+        try:
+            # the known pages are read here: the store is not shared
+            tasks = [(repo, pool.submit(self.fetch, repo,
+                                        self.store.pages(repo)))
+                     for repo in repos]
+            written = {}
+            for repo, task in tasks:
+                with self.metrics.stage("record"):
+                    written[repo] = self.store.record(repo, task.result(),
+                                                      now)
+            cancel = False
+        finally:
+            pool.close(cancel)
+        return written
+
+def _day(ts):
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options] poll REPO... | "
+                          "total REPO | daily REPO | top REPO | "
+                          "history REPO NAME | repos")
+    parser.add_option("--db", default="downloadstats.sqlite",
+                      help="The SQLite store")
+    parser.add_option("-u", "--user")
+    parser.add_option("-p", "--pass", dest="password")
+    parser.add_option("--api", help="GitHub API base URL")
+    parser.add_option("--workers", type="int", default=4,
+                      help="Repositories to fetch at once")
+    parser.add_option("--since", type="float",
+                      help="Only count the last this many days")
+    parser.add_option("--name", metavar="PATTERN",
+                      help="Only count downloads matching this glob pattern")
+    parser.add_option("--limit", type="int", default=10)
+
+    opts, args = parser.parse_args()
+    if not args:
+        parser.error("no command given")
+    command, args = args[0], args[1:]
+    nargs = {"poll": None, "total": 1, "daily": 1, "top": 1, "history": 2,
+             "repos": 0}
+    if command not in nargs:
+        parser.error("unknown command: %s" % command)
+    if nargs[command] is not None and len(args) != nargs[command]:
+        parser.error("%s takes %d arguments" % (command, nargs[command]))
+
+    start = None
+    if opts.since is not None:
+        start = time.time() - opts.since * 86400
+
+    store = StatsStore(opts.db)
+    try:
+        if command == "poll":
+            if not opts.user or not opts.password:
+                parser.error("poll needs --user and --pass")
+            collector = Collector(store, opts.user, opts.password,
+                                  api=opts.api, workers=opts.workers)
+            for repo, n in sorted(collector.poll(args).items()):
+                print "%s: %d changed" % (repo, n)
+        elif command == "total":
+            print store.total(args[0], start, pattern=opts.name)
+        elif command == "daily":
+            for day, n in store.per_period(args[0], 86400, start,
+                                           pattern=opts.name):
+                print "%s %8d" % (_day(day), n)
+        elif command == "top":
+            for name, n in store.top(args[0], start, pattern=opts.name,
+                                     limit=opts.limit):
+                print "%8d %s" % (n, name)
+        elif command == "history":
+            for ts, count in store.history(args[0], args[1], start):
+                print "%s %8d" % (time.strftime("%Y-%m-%d %H:%M",
+                                                time.gmtime(ts)), count)
+        else:
+            for repo, polled in store.repos():
+                print "%s %s" % (repo, time.strftime("%Y-%m-%d %H:%M",
+                                                     time.gmtime(polled)))
+    finally:
+        store.close()
+    return 0
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
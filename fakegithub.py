@@ -0,0 +1,440 @@
+""" A local stand-in for the GitHub downloads API and its S3 endpoint.
+
+Serves the parts of the API githubdownloads uses: listing with Link
+pagination and ETags, get, create (including already_exists errors), delete,
+rate-limit headers, the S3 multipart POST and the download_url of
+every uploaded file.  Latency, bandwidth and failures can be injected
+to benchmark or exercise Downloads and nightly offline.
+
+Example:
+
+from fakegithub import FakeGitHub
+with FakeGitHub(latency=0.05) as gh:
+    d = Downloads("owner/repo", "user", "pass", api=gh.url)
+    d.upload("some.xpi")
+
+or run it standalone: python fakegithub.py --port 8000 --fail create=0.1
+"""
+
+import cgi
+import hashlib
+import json
+import random
+import re
+import socket
+import threading
+import time
+import urlparse
+import zlib
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+from SocketServer import ThreadingMixIn
+
+__all__ = ["FakeGitHub"]
+
+ENDPOINTS = ["list", "get", "create", "delete", "s3", "file"]
+
+API_RE = re.compile(r"^/repos/([^/]+/[^/]+)/downloads(?:/(\d+))?/?$")
+FILE_RE = re.compile(r"^/downloads/([^/]+/[^/]+)/([^/]+)$")
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.fake.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        self.server.fake._dispatch(self, "GET")
+
+    def do_POST(self):
+        self.server.fake._dispatch(self, "POST")
+
+    def do_DELETE(self):
+        self.server.fake._dispatch(self, "DELETE")
+
+class FakeGitHub(object):
+    """ The fake server; start() it or use it as a context manager.
+
+    latency - seconds to wait before answering each request.
+    bandwidth - bytes per second for request and response bodies,
+        or None for unthrottled.
+    failures - dict of endpoint ('list', 'get', 'create', 'delete',
+        's3', 'file') to the probability of answering with a 500.
+    per_page - default page size of listings.
+    rate_limit - API requests allowed per rate_window seconds; the
+        next ones are answered with a 403 until the window resets.
+    gzip - compress JSON responses for clients accepting gzip.
+    """
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, bandwidth=None,
+                 failures=None, per_page=30, rate_limit=5000, seed=None,
+                 verbose=False, gzip=True, rate_window=3600):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failures = dict(failures or {})
+        self.per_page = per_page
+        self.rate_limit = rate_limit
+        self.remaining = rate_limit
+        self.rate_window = rate_window
+        self.rate_reset = int(time.time()) + rate_window
+        self.verbose = verbose
+        self.gzip = gzip
+        self.bytes_sent = 0
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.downloads = {}
+        self.files = {}
+        self.forced = {}
+        self.requests = dict((e, 0) for e in ENDPOINTS)
+        self.server = _Server((host, port), _Handler)
+        self.server.fake = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name="fakegithub")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def fail_next(self, endpoint, count=1, status=500):
+        """ Answer the next count requests to endpoint with status. """
+        with self.lock:
+            self.forced[endpoint] = [status] * count
+
+    def add(self, repo, name, data="", description=None):
+        """ Put a finished download in place without going through HTTP. """
+        with self.lock:
+            d = self._create(repo, name, len(data), description, None)
+            self.files[(repo, name)] = data
+        return d
+
+    def listing(self, repo):
+        """ The downloads of repo, newest first. """
+        with self.lock:
+            return sorted(self.downloads.get(repo, {}).values(),
+                          key=lambda d: d["id"], reverse=True)
+
+    # --- Request handling
+
+    def _create(self, repo, name, size, description, content_type):
+        id = self.next_id
+        self.next_id += 1
+        d = {"id": id,
+             "name": name,
+             "size": size,
+             "description": description,
+             "content_type": content_type or "application/octet-stream",
+             "download_count": 0,
+             "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+             "url": "%s/repos/%s/downloads/%d" % (self.url, repo, id),
+             "html_url": "%s/downloads/%s/%s" % (self.url, repo, name)
+             }
+        self.downloads.setdefault(repo, {})[id] = d
+        return d
+
+    def _find(self, repo, name):
+        for d in self.downloads.get(repo, {}).values():
+            if d["name"] == name:
+                return d
+        return None
+
+    def _throttle(self, size):
+        if self.bandwidth and size:
+            time.sleep(float(size) / self.bandwidth)
+
+    def _read_body(self, h):
+        size = int(h.headers.get("Content-Length") or 0)
+        body = BytesIO()
+        while size > 0:
+            chunk = h.rfile.read(min(size, 65536))
+            if not chunk:
+                break
+            self._throttle(len(chunk))
+            body.write(chunk)
+            size -= len(chunk)
+        return body.getvalue()
+
+    def _respond(self, h, status, body="", headers=None, content_type=None):
+        if not isinstance(body, basestring):
+            body = json.dumps(body)
+            content_type = content_type or "application/json; charset=utf-8"
+            if self.gzip and "gzip" in h.headers.get("Accept-Encoding", ""):
+                z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                body = z.compress(body) + z.flush()
+                headers = dict(headers or {}, **{"Content-Encoding": "gzip"})
+        with self.lock:
+            self.bytes_sent += len(body)
+        h.send_response(status)
+        if content_type:
+            h.send_header("Content-Type", content_type)
+        h.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            h.send_header(k, v)
+        h.end_headers()
+        for i in range(0, len(body), 65536):
+            chunk = body[i:i + 65536]
+            self._throttle(len(chunk))
+            h.wfile.write(chunk)
+
+    def _injected(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] += 1
+            forced = self.forced.get(endpoint)
+            if forced:
+                return forced.pop()
+            p = self.failures.get(endpoint)
+            if p and self.random.random() < p:
+                return 500
+        return None
+
+    def _dispatch(self, h, method):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse.urlparse(h.path)
+        query = urlparse.parse_qs(url.query)
+        try:
+            m = API_RE.match(url.path)
+            if m:
+                body = self._read_body(h)
+                self._api(h, method, m.group(1), m.group(2), query, body)
+                return
+            if url.path.rstrip("/") == "/s3" and method == "POST":
+                body = self._read_body(h)
+                self._s3(h, body)
+                return
+            m = FILE_RE.match(url.path)
+            if m and method == "GET":
+                self._file(h, m.group(1), urlparse.unquote(m.group(2)))
+                return
+            self._respond(h, 404, {"message": "Not Found"})
+        except socket.error:
+            h.close_connection = 1
+
+    def _api(self, h, method, repo, id, query, body):
+        if id is not None:
+            id = int(id)
+        if method == "GET":
+            endpoint = id is None and "list" or "get"
+        elif method == "POST" and id is None:
+            endpoint = "create"
+        elif method == "DELETE" and id is not None:
+            endpoint = "delete"
+        else:
+            self._respond(h, 404, {"message": "Not Found"})
+            return
+
+        if not h.headers.get("Authorization", "").startswith("Basic "):
+            self._respond(h, 401, {"message": "Requires authentication"})
+            return
+
+        with self.lock:
+            now = time.time()
+            if now >= self.rate_reset:
+                self.remaining = self.rate_limit
+                self.rate_reset = int(now) + self.rate_window
+            limited = not self.remaining
+            if not limited:
+                self.remaining -= 1
+            remaining, reset = self.remaining, self.rate_reset
+        headers = {"X-RateLimit-Limit": str(self.rate_limit),
+                   "X-RateLimit-Remaining": str(remaining),
+                   "X-RateLimit-Reset": str(reset)
+                   }
+        if limited:
+            self._respond(h, 403, {"message": "API rate limit exceeded"}, headers)
+            return
+
+        status = self._injected(endpoint)
+        if status:
+            self._respond(h, status, {"message": "Injected failure"}, headers)
+            return
+
+        if endpoint == "list":
+            self._list(h, repo, query, headers)
+            return
+
+        with self.lock:
+            if endpoint == "create":
+                try:
+                    j = json.loads(body)
+                except ValueError:
+                    rv = 400, {"message": "Problems parsing JSON"}
+                else:
+                    if self._find(repo, j.get("name")):
+                        rv = 422, {"message": "Validation Failed",
+                                   "errors": [{"resource": "Download",
+                                               "code": "already_exists",
+                                               "field": "name"}]
+                                   }
+                    else:
+                        d = self._create(repo, j["name"], j["size"],
+                                         j.get("description"),
+                                         j.get("content_type"))
+                        rv = 201, dict(d,
+                                       policy="fake-policy",
+                                       signature="fake-signature",
+                                       bucket="github",
+                                       accesskeyid="fake-key",
+                                       path="downloads/%s/%s" % (repo, d["name"]),
+                                       acl="public-read",
+                                       expirationdate="2099-01-01T00:00:00Z",
+                                       prefix="downloads/%s/" % repo,
+                                       mime_type=d["content_type"],
+                                       redirect=False,
+                                       s3_url="%s/s3/" % self.url)
+            else:
+                d = self.downloads.get(repo, {}).get(id)
+                if not d:
+                    rv = 404, {"message": "Not Found"}
+                elif endpoint == "get":
+                    rv = 200, d
+                else:
+                    del self.downloads[repo][id]
+                    self.files.pop((repo, d["name"]), None)
+                    rv = 204, ""
+        self._respond(h, rv[0], rv[1], headers)
+
+    def _list(self, h, repo, query, headers):
+        per_page = int(query.get("per_page", [self.per_page])[0])
+        page = int(query.get("page", [1])[0])
+        items = self.listing(repo)
+        last = max(1, (len(items) + per_page - 1) // per_page)
+        base = "%s/repos/%s/downloads?per_page=%d&page=" % (self.url, repo, per_page)
+        links = []
+        if page < last:
+            links.append('<%s%d>; rel="next"' % (base, page + 1))
+            links.append('<%s%d>; rel="last"' % (base, last))
+        if page > 1:
+            links.append('<%s1>; rel="first"' % base)
+            links.append('<%s%d>; rel="prev"' % (base, page - 1))
+        if links:
+            headers = dict(headers, Link=", ".join(links))
+        items = items[(page - 1) * per_page:page * per_page]
+        etag = '"%s"' % hashlib.sha1(json.dumps(items, sort_keys=True)).hexdigest()
+        headers = dict(headers, ETag=etag)
+        if h.headers.get("If-None-Match") == etag:
+            # like GitHub, a 304 does not count against the rate limit
+            with self.lock:
+                self.remaining += 1
+            headers["X-RateLimit-Remaining"] = str(self.remaining)
+            self._respond(h, 304, "", headers)
+            return
+        self._respond(h, 200, items, headers)
+
+    def _s3(self, h, body):
+        status = self._injected("s3")
+        if status:
+            self._respond(h, status, "<Error>Injected failure</Error>",
+                          content_type="application/xml")
+            return
+        form = cgi.FieldStorage(fp=BytesIO(body),
+                                headers=h.headers,
+                                environ={"REQUEST_METHOD": "POST",
+                                         "CONTENT_TYPE": h.headers.get("Content-Type"),
+                                         "CONTENT_LENGTH": str(len(body))
+                                         })
+        key = form.getfirst("key", "")
+        m = re.match(r"^downloads/([^/]+/[^/]+)/(.+)$", key)
+        if not m or "file" not in form:
+            self._respond(h, 400, "<Error>Bad form</Error>",
+                          content_type="application/xml")
+            return
+        repo, name = m.groups()
+        data = form["file"].value
+        with self.lock:
+            d = self._find(repo, name)
+            if d is None or d["size"] != len(data):
+                d = None
+            else:
+                self.files[(repo, name)] = data
+        if d is None:
+            self._respond(h, 400, "<Error>No such reservation</Error>",
+                          content_type="application/xml")
+            return
+        self._respond(h, int(form.getfirst("success_action_status", "204")),
+                      "<PostResponse><Key>%s</Key></PostResponse>" % key,
+                      content_type="application/xml")
+
+    def _file(self, h, repo, name):
+        status = self._injected("file")
+        if status:
+            self._respond(h, status, "")
+            return
+        with self.lock:
+            d = self._find(repo, name)
+            data = self.files.get((repo, name))
+            if d is not None and data is not None:
+                d["download_count"] += 1
+        if data is None:
+            self._respond(h, 404, "")
+            return
+        self._respond(h, 200, data, content_type=d["content_type"])
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("--host", default="127.0.0.1")
+    parser.add_option("--port", type="int", default=8000)
+    parser.add_option("--latency", type="float", default=0.0,
+                      help="Seconds to wait before each response")
+    parser.add_option("--bandwidth", type="int",
+                      help="Throttle bodies to this many bytes per second")
+    parser.add_option("--fail", action="append", default=[],
+                      metavar="ENDPOINT=P",
+                      help="Fail this share of requests to ENDPOINT (%s)"
+                      % ", ".join(ENDPOINTS))
+    parser.add_option("--per-page", type="int", default=30)
+    parser.add_option("--rate-limit", type="int", default=5000)
+    parser.add_option("--rate-window", type="int", default=3600,
+                      help="Seconds until the rate limit resets")
+    parser.add_option("--no-gzip", action="store_true",
+                      help="Never compress responses")
+
+    opts, args = parser.parse_args()
+    failures = {}
+    for f in opts.fail:
+        endpoint, p = f.split("=", 1)
+        if endpoint not in ENDPOINTS:
+            parser.error("Unknown endpoint: %s" % endpoint)
+        failures[endpoint] = float(p)
+
+    gh = FakeGitHub(host=opts.host,
+                    port=opts.port,
+                    latency=opts.latency,
+                    bandwidth=opts.bandwidth,
+                    failures=failures,
+                    per_page=opts.per_page,
+                    rate_limit=opts.rate_limit,
+                    rate_window=opts.rate_window,
+                    verbose=True,
+                    gzip=not opts.no_gzip
+                    )
+    print "Serving on %s" % gh.url
+    try:
+        gh.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -4,11 +4,18 @@ import base64
 from io import BytesIO
 import json
 import random
+import re
+import sys
+import threading
+import time
 import urllib2
+import zlib
 
-__all__ = ["Downloads"]
+from metrics import NullMetrics
 
-GITHUB_API = "https://api.github.com/repos/%s/downloads"
+__all__ = ["Downloads", "Reservation", "Task"]
+
+GITHUB_API = "https://api.github.com"
 
 class MethodRequest(urllib2.Request):
     def get_method(self):
@@ -18,9 +25,18 @@ class MethodRequest(urllib2.Request):
 
 
 class S3Multipart(object):
+    """The multipart/form-data body of an S3 POST, as a file-like object.
+
+    The form fields are rendered up front; the file itself is read from
+    file_obj in chunk_size pieces while the body is being sent, so the
+    data is never held in memory as a whole.  read() hands out up to
+    chunk_size bytes per call even if asked for less, as httplib asks
+    for small blocks but sends whatever it gets.
+    """
     boundary = "ghd%16.16x" % random.randint(0, 1<<64)
+    chunk_size = 1 << 16
 
-    def __init__(self, j, file_data):
+    def __init__(self, j, file_obj, file_size, chunk_size=None, progress=None):
         self.data = BytesIO()
         self.add_field("key", j["path"])
         self.add_field("acl", j["acl"])
@@ -30,9 +46,23 @@ class S3Multipart(object):
         self.add_field("Policy", j["policy"])
         self.add_field("Signature", j["signature"])
         self.add_field("Content-Type", j["mime_type"])
-        self.add_file("file", j["name"], j["mime_type"], file_data)
-        self.data.write("--" + self.boundary + "--\r\n\r\n")
-        self.data.seek(0,0)
+        self.add_file("file", j["name"], j["mime_type"])
+        self.head = self.data.getvalue()
+        self.tail = "\r\n--" + self.boundary + "--\r\n\r\n"
+        self.data = None
+        self.length = len(self.head) + file_size + len(self.tail)
+
+        self.file_obj = file_obj
+        self.file_size = file_size
+        self.file_left = file_size
+        if chunk_size:
+            self.chunk_size = chunk_size
+        self.progress = progress
+        self.sent = 0
+        self.started = None
+
+    def __len__(self):
+        return self.length
 
     def add_field(self, key, value):
         self.data.write("--" + self.boundary)
@@ -45,7 +75,7 @@ class S3Multipart(object):
         self.data.write(str(value))
         self.data.write("\r\n")
 
-    def add_file(self, key, file_name, mime, value):
+    def add_file(self, key, file_name, mime):
         self.data.write("--" + self.boundary)
         self.data.write("\r\n")
         self.data.write('Content-Disposition: form-data; name="%s"; filename="%s"'
@@ -55,13 +85,178 @@ class S3Multipart(object):
         self.data.write('Content-Type: %s' % str(mime))
         self.data.write("\r\n")
         self.data.write("\r\n")
-        self.data.write(value)
-        self.data.write("\r\n")
+
+    def read(self, size=-1):
+        if self.started is None:
+            self.started = time.time()
+        if self.head:
+            rv, self.head = self.head, ""
+        elif self.file_left:
+            rv = self.file_obj.read(min(self.file_left, self.chunk_size))
+            if not rv:
+                raise DownloadsException("File shrank while uploading")
+            self.file_left -= len(rv)
+        else:
+            rv, self.tail = self.tail, ""
+        self.sent += len(rv)
+        if self.progress and rv:
+            self.progress(self.sent, self.length, time.time() - self.started)
+        return rv
+
+def remaining_size(file_obj):
+    """Bytes left in file_obj from its current position."""
+    try:
+        return os.fstat(file_obj.fileno()).st_size - file_obj.tell()
+    except (AttributeError, IOError, ValueError):
+        pos = file_obj.tell()
+        file_obj.seek(0, os.SEEK_END)
+        try:
+            return file_obj.tell() - pos
+        finally:
+            file_obj.seek(pos)
 
 class DownloadsException(Exception):
     pass
 
+def parse_links(header):
+    """Map each rel of a Link header to its URL."""
+    links = {}
+    for link in (header or "").split(","):
+        parts = link.split(";")
+        url = parts[0].strip()
+        if not url.startswith("<") or not url.endswith(">"):
+            continue
+        for p in parts[1:]:
+            k, _, v = p.strip().partition("=")
+            if k == "rel":
+                for rel in v.strip('"').split():
+                    links[rel] = url[1:-1]
+    return links
+
+class GzipResponse(object):
+    """A response whose gzip encoded body is decompressed as it is read.
+
+    Everything but read() is passed through to the response.
+    """
+    chunk_size = 1 << 14
+
+    def __init__(self, resp):
+        self.resp = resp
+        # 16 + MAX_WBITS: expect a gzip header and trailer
+        self.z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buf = ""
+        self.eof = False
+
+    def __getattr__(self, name):
+        return getattr(self.resp, name)
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buf) < size):
+            data = self.resp.read(self.chunk_size)
+            if data:
+                self.buf += self.z.decompress(data)
+            else:
+                self.buf += self.z.flush()
+                self.eof = True
+        if size < 0:
+            data, self.buf = self.buf, ""
+        else:
+            data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+def is_gzipped(resp):
+    return (resp.info().getheader("Content-Encoding") or "").strip() == "gzip"
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+def iter_json_array(fp, chunk_size=1 << 14):
+    """Yield the elements of the JSON array read from fp.
+
+    Each element is decoded as soon as it has arrived in full, so
+    decoding overlaps the transfer of the rest of the array.
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    state = "start"
+    while True:
+        pos = _WHITESPACE.match(buf, pos).end()
+        if pos == len(buf):
+            if eof:
+                raise ValueError("Truncated JSON array")
+            data = fp.read(chunk_size)
+            buf = buf[pos:] + data
+            pos = 0
+            eof = not data
+            continue
+        c = buf[pos]
+        if state == "start":
+            if c != "[":
+                raise ValueError("Expected a JSON array")
+            pos += 1
+            state = "first"
+        elif c == "]" and state != "value":
+            return
+        elif state == "next":
+            if c != ",":
+                raise ValueError("Expected ',' or ']' in JSON array")
+            pos += 1
+            state = "value"
+        else:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                end = None
+            # a value not followed by ',' or ']' yet may be cut short,
+            # like 1 of 1.5
+            if end is not None and not eof:
+                after = _WHITESPACE.match(buf, end).end()
+                if after == len(buf) or buf[after] not in ",]":
+                    end = None
+            if end is None:
+                data = fp.read(chunk_size)
+                buf = buf[pos:] + data
+                pos = 0
+                eof = not data
+                continue
+            yield value
+            pos = end
+            state = "next"
+
+class Task(threading.Thread):
+    """Run a callable on a background thread.
+
+    result() waits for the callable and returns its value, re-raising
+    any exception it raised in the calling thread.
+    """
+    def __init__(self, fn, *args, **kw):
+        threading.Thread.__init__(self, name=getattr(fn, "__name__", None))
+        self.daemon = True
+        self.fn = fn
+        self.args = args
+        self.kw = kw
+        self.value = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.value = self.fn(*self.args, **self.kw)
+        except:
+            self.exc_info = sys.exc_info()
+
+    def result(self):
+        self.join()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
 class DownloadInfo(object):
+    __slots__ = ("owner", "description", "download_count", "size", "name",
+                 "id", "api_url", "download_url")
+
     def __init__(self, owner, data):
         self.owner = owner
         for x in ["description", "download_count", "size", "name", "id"]:
@@ -74,15 +269,77 @@ class DownloadInfo(object):
         return "%s (%d)" % (self.name, self.id)
 
     def delete(self):
-        self.owner.delete(self.id)
+        return self.owner.delete(self.id)
+
+class Reservation(object):
+    """A created download whose data still has to go to S3.
+
+    source is a file name, or a file object positioned at the start of
+    the data; either way it is only read once the transfer starts.
+    """
+    def __init__(self, owner, j, source, size, progress=None):
+        self.owner = owner
+        self.j = j
+        self.source = source
+        self.size = size
+        self.progress = progress
+        if not isinstance(source, basestring):
+            self.offset = source.tell()
+        self.info = DownloadInfo(owner, j)
+
+    def __repr__(self):
+        return "<Reservation %r>" % self.info
+
+    def transfer(self):
+        """Send the data to S3 and return the DownloadInfo.
+
+        Streams the data from its source and may be called again after
+        a failure; file objects are seeked back rather than buffered.
+        """
+        if isinstance(self.source, basestring):
+            fo = open(self.source, "rb")
+        else:
+            fo = self.source
+            fo.seek(self.offset)
+        try:
+            data = S3Multipart(self.j, fo, self.size, progress=self.progress)
+            datalen = len(data)
+            req = MethodRequest(url=self.j["s3_url"],
+                                data=data,
+                                headers={"Content-Type": ("multipart/form-data; boundary=%s"
+                                                          % S3Multipart.boundary),
+                                         "Content-Length": datalen
+                                         }
+                                )
+            metrics = self.owner.metrics
+            metrics.count("bytes_sent", datalen)
+            with metrics.stage("upload"):
+                with metrics.request("POST s3"):
+                    self.owner.opener.open(req).read()
+        finally:
+            if fo is not self.source:
+                fo.close()
+        return self.info
+
+    def start(self):
+        """Run transfer() on a Task and return the started task."""
+        task = Task(self.transfer)
+        task.start()
+        return task
+
+    def checkpoint(self):
+        """What Downloads.resume() needs to make this reservation again."""
+        return {"j": self.j}
 
 class Downloads(object):
-    def __init__(self, repo, user, password, debug=0):
+    def __init__(self, repo, user, password, debug=0, metrics=None,
+                 api=GITHUB_API):
         self.repo = repo
         self.user = user
         self.password = password
+        self.metrics = metrics or NullMetrics()
 
-        self.api = GITHUB_API % (repo)
+        self.api = "%s/repos/%s/downloads" % (api.rstrip("/"), repo)
 
         raw = "%s:%s" % (user, password)
         self.auth = 'Basic %s' % base64.b64encode(raw).strip()
@@ -90,18 +347,82 @@ class Downloads(object):
         https_handler = urllib2.HTTPSHandler(debuglevel=debug)
         self.opener = urllib2.build_opener(https_handler)
 
-    def _request(self, additional_path=None, data=None, headers={}, method=None):
-        api = self.api
+    def _request(self, additional_path=None, data=None, headers=None, method=None,
+                 url=None):
+        api = url or self.api
         if additional_path:
             api += additional_path
+        headers = dict(headers or {})
         headers['Authorization'] = self.auth
+        headers.setdefault('Accept-Encoding', 'gzip')
         req = MethodRequest(url=api, data=data, headers=headers)
         if method:
             req.method = method
-        return self.opener.open(req)
+        endpoint = "%s downloads%s" % (req.get_method(),
+                                       additional_path and "/:id" or "")
+        if data:
+            self.metrics.count("bytes_sent", len(data))
+        with self.metrics.request(endpoint):
+            try:
+                resp = self.opener.open(req)
+            except urllib2.HTTPError, ex:
+                if not is_gzipped(ex):
+                    raise
+                raise urllib2.HTTPError(ex.geturl(), ex.code, ex.msg, ex.hdrs,
+                                        GzipResponse(ex))
+        if is_gzipped(resp):
+            return GzipResponse(resp)
+        return resp
+
+    def iter_list(self, per_page=100):
+        """Yield a DownloadInfo per download, fetching pages lazily.
+
+        Follows the Link headers of the listing, so nothing is truncated,
+        and only requests the next page once the current one is used up.
+        Each page is decoded while it arrives.
+        """
+        url = "%s?per_page=%d" % (self.api, per_page)
+        while url:
+            resp = self._request(url=url)
+            url = parse_links(resp.info().getheader("Link")).get("next")
+            for i in iter_json_array(resp):
+                yield DownloadInfo(self, i)
+
+    def iter_pages(self, known=None, per_page=100):
+        """Yield (url, etag, next_url, downloads) per page of the listing.
+
+        known maps page URLs to the (etag, next_url) of an earlier pass.
+        A page that has not changed since is not sent again: GitHub
+        answers 304, which does not count against the rate limit, and
+        downloads is None.
+        """
+        known = known or {}
+        url = "%s?per_page=%d" % (self.api, per_page)
+        while url:
+            headers = {}
+            if url in known:
+                headers["If-None-Match"] = known[url][0]
+            try:
+                resp = self._request(url=url, headers=headers)
+            except urllib2.HTTPError, ex:
+                if ex.code != 304:
+                    raise
+                self.metrics.count("not_modified")
+                etag, next_url = known[url]
+                links = ex.info().getheader("Link")
+                if links is not None:
+                    next_url = parse_links(links).get("next")
+                yield url, etag, next_url, None
+                url = next_url
+                continue
+            info = resp.info()
+            next_url = parse_links(info.getheader("Link")).get("next")
+            yield (url, info.getheader("ETag"), next_url,
+                   [DownloadInfo(self, i) for i in iter_json_array(resp)])
+            url = next_url
 
     def list(self):
-        return [DownloadInfo(self, i) for i in json.load(self._request())]
+        return list(self.iter_list())
 
     def delete(self, id_or_name):
         if not isinstance(id_or_name, int):
@@ -112,36 +433,37 @@ class Downloads(object):
 
     def get_info_by_id(self, id):
         j = json.load(self._request(additional_path=("/%d" % id)))
-        return DownloadInfo(j)
+        return DownloadInfo(self, j)
 
     def get_info_by_name(self, name):
-        for d in self.list():
+        for d in self.iter_list():
             if d.name == name:
                 return d
         raise DownloadsException("no download with that name")
 
 
-    def upload(self, file_or_name, file_name=None, mime=None, replace=False):
+    def reserve(self, file_or_name, file_name=None, mime=None, replace=False,
+                progress=None):
+        """Create the download, but do not send any data yet.
+
+        Returns a Reservation; its info is already complete, including
+        the download_url. Call transfer() or start() to send the data.
+
+        The size is taken from stat (or by seeking), so nothing is read
+        here.  progress, if given, is called as progress(sent, total,
+        elapsed) while the data is being sent.
+        """
         if isinstance(file_or_name, basestring):
-            fo = open(file_or_name, "rb")
-            try:
-                io = BytesIO(fo.read())
-            finally:
-                fo.close()
-            return self.upload(io,
-                               file_name or os.path.basename(file_or_name),
-                               mime=mime,
-                               replace=replace
-                               )
+            size = os.stat(file_or_name).st_size
+            file_name = file_name or os.path.basename(file_or_name)
+        else:
+            size = remaining_size(file_or_name)
 
         if not file_name:
             raise DownloadsException("Must provide a file name")
 
-        data = file_or_name.read()
-        data_len = len(data)
-
         j = {"name": file_name,
-             "size": data_len
+             "size": size
              }
         if mime:
             j["content_type"] = mime
@@ -157,26 +479,34 @@ class Downloads(object):
             for e in j["errors"]:
                 if e["code"] == "already_exists":
                     self.delete(file_name)
-                    return self.upload(
-                                       BytesIO(data),
-                                       file_name,
-                                       mime=mime,
-                                       replace=False)
+                    return self.reserve(
+                                        file_or_name,
+                                        file_name,
+                                        mime=mime,
+                                        replace=False,
+                                        progress=progress)
             raise
 
-        j = json.load(req)
-        rv = DownloadInfo(self, j)
-        data = S3Multipart(j, data).data
-        datalen = len(data.getvalue())
-        req = MethodRequest(url=j["s3_url"],
-                            data=data,
-                            headers={"Content-Type": ("multipart/form-data; boundary=%s"
-                                                      % S3Multipart.boundary),
-                                     "Content-Length": datalen
-                                     }
-                            )
-        self.opener.open(req).read()
-        return rv
+        return Reservation(self, json.load(req), file_or_name, size,
+                           progress=progress)
+
+    def resume(self, checkpoint, file_or_name, progress=None):
+        """Make the Reservation of checkpoint() again, in another run.
+
+        file_or_name must hold the same data as when it was reserved.
+        """
+        j = checkpoint["j"]
+        return Reservation(self, j, file_or_name, j["size"],
+                           progress=progress)
+
+    def upload(self, file_or_name, file_name=None, mime=None, replace=False,
+               progress=None):
+        return self.reserve(file_or_name,
+                            file_name,
+                            mime=mime,
+                            replace=replace,
+                            progress=progress
+                            ).transfer()
 
 if __name__ == "__main__":
     from optparse import OptionParser
@@ -193,15 +523,35 @@ if __name__ == "__main__":
     parser.add_option("-p",
                       "--password",
                       help="Password")
+    parser.add_option("--api",
+                      default=GITHUB_API,
+                      help="API base URL, e.g. of a fakegithub server")
+    parser.add_option("--profile",
+                      metavar="PREFIX",
+                      help="Profile the upload, writing PREFIX.pstats and PREFIX.collapsed")
 
     opts, args = parser.parse_args()
     if not opts.repo or not opts.user or not opts.password:
         parser.error("Need to provide repo, user and password")
 
+    metrics = None
+    if opts.profile:
+        from metrics import Metrics
+        from profiling import Profiler
+        metrics = Metrics()
+        profiler = Profiler(opts.profile, metrics)
+        profiler.start()
+
     d = Downloads(
                   repo=opts.repo,
                   user=opts.user,
                   password=opts.password,
-                  debug=0
+                  debug=0,
+                  metrics=metrics,
+                  api=opts.api
                   )
-    print d.upload(args[0], replace=True)
+    try:
+        print d.upload(args[0], replace=True)
+    finally:
+        if opts.profile:
+            profiler.stop()
@@ -0,0 +1,358 @@
+""" Publish downloads into a local directory tree.
+
+LocalDownloads has the interface of githubdownloads.Downloads, so
+nightly can publish to a directory served by a static host instead of
+GitHub.  Layout of the root directory:
+
+  NAME            - the published files
+  .objects/SHA1   - content store; published files are hard links into
+                    it, so identical artifacts share their blocks; an
+                    object goes away with the last file using it
+  .index.json     - the listing, read in one go by list()
+
+Every change is made visible by an atomic rename: readers of the root
+see either the old or the new file, and the old or the new index.
+
+Example:
+
+from localdownloads import LocalDownloads
+d = LocalDownloads("/srv/www/nightly", "https://example.com/nightly")
+print d.upload("some.xpi", replace=True).download_url
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib
+
+from githubdownloads import DownloadInfo, DownloadsException, Task, remaining_size
+from metrics import NullMetrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__all__ = ["LocalDownloads"]
+
+INDEX = ".index.json"
+OBJECTS = ".objects"
+
+class LocalReservation(object):
+    """ A download entered into the index whose data is not in place yet. """
+    def __init__(self, owner, j, replaced, source, progress=None):
+        self.owner = owner
+        self.j = j
+        self.replaced = replaced
+        self.source = source
+        self.progress = progress
+        if not isinstance(source, basestring):
+            self.offset = source.tell()
+        self.info = DownloadInfo(owner, j)
+
+    def __repr__(self):
+        return "<LocalReservation %r>" % self.info
+
+    def transfer(self):
+        """ Put the data in place and return the DownloadInfo. """
+        if isinstance(self.source, basestring):
+            fo = open(self.source, "rb")
+        else:
+            fo = self.source
+            fo.seek(self.offset)
+        try:
+            with self.owner.metrics.stage("upload"):
+                try:
+                    self.owner._publish(self.j, self.replaced, fo,
+                                        self.progress)
+                except:
+                    # the replaced file is still served; list it again
+                    if self.replaced:
+                        self.owner._locked(self.owner._restore, self.j,
+                                           self.replaced)
+                    raise
+        finally:
+            if fo is not self.source:
+                fo.close()
+        return self.info
+
+    def start(self):
+        task = Task(self.transfer)
+        task.start()
+        return task
+
+    def checkpoint(self):
+        return {"j": self.j, "replaced": self.replaced}
+
+class LocalDownloads(object):
+    chunk_size = 1 << 16
+
+    def __init__(self, root, base_url, metrics=None):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.base_url = base_url.rstrip("/")
+        self.metrics = metrics or NullMetrics()
+        self.objects = os.path.join(self.root, OBJECTS)
+        self.index_file = os.path.join(self.root, INDEX)
+        self.lock = threading.Lock()
+        # mkstemp creates private files; published ones follow the umask
+        umask = os.umask(0)
+        os.umask(umask)
+        self.mode = 0666 & ~umask
+        for d in (self.root, self.objects):
+            try:
+                os.makedirs(d)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    # --- The index
+
+    def _read_index(self):
+        try:
+            with open(self.index_file, "rb") as fp:
+                return json.load(fp)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {"next_id": 1, "downloads": []}
+
+    def _write_index(self, index):
+        fd, tmp = tempfile.mkstemp(prefix=INDEX, dir=self.root)
+        os.fchmod(fd, self.mode)
+        with os.fdopen(fd, "wb") as fp:
+            json.dump(index, fp)
+        os.rename(tmp, self.index_file)
+
+    def _locked(self, fn, *args):
+        """ Run fn(index, *args) under the thread and file lock, saving
+        the index afterwards if fn returns True as its first value. """
+        with self.lock:
+            lock_fp = None
+            if fcntl is not None:
+                lock_fp = open(os.path.join(self.root, ".lock"), "ab")
+                fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX)
+            try:
+                index = self._read_index()
+                changed, rv = fn(index, *args)
+                if changed:
+                    self._write_index(index)
+                return rv
+            finally:
+                if lock_fp is not None:
+                    lock_fp.close()
+
+    def _entry(self, id, name, size, mime):
+        path = os.path.join(self.root, name)
+        return {"id": id,
+                "name": name,
+                "size": size,
+                "content_type": mime or "application/octet-stream",
+                "download_count": 0,
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "url": "file:" + urllib.pathname2url(path),
+                "html_url": "%s/%s" % (self.base_url, urllib.quote(name))
+                }
+
+    # --- Downloads interface
+
+    def iter_list(self, per_page=None):
+        with self.metrics.request("GET index"):
+            index = self._read_index()
+        for d in index["downloads"]:
+            yield DownloadInfo(self, d)
+
+    def list(self):
+        return list(self.iter_list())
+
+    def get_info_by_id(self, id):
+        for d in self.iter_list():
+            if d.id == id:
+                return d
+        raise DownloadsException("no download with that id")
+
+    def get_info_by_name(self, name):
+        for d in self.iter_list():
+            if d.name == name:
+                return d
+        raise DownloadsException("no download with that name")
+
+    def delete(self, id_or_name):
+        with self.metrics.request("DELETE index"):
+            self._locked(self._delete, id_or_name)
+
+    def _delete(self, index, id_or_name):
+        """ Drop the entry and its file in one go, so that a file of the
+        same name published meanwhile is never removed. """
+        for i, d in enumerate(index["downloads"]):
+            if id_or_name in (d["id"], d["name"]):
+                break
+        else:
+            raise DownloadsException("no download with that name")
+        index["downloads"].pop(i)
+        try:
+            os.unlink(os.path.join(self.root, d["name"]))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        self._release(d.get("object"))
+        return True, None
+
+    def _release(self, object):
+        """ Remove an object no published file links to any more; only
+        under the lock, so that nothing links to it meanwhile. """
+        if not object:
+            return
+        obj = os.path.join(self.objects, object)
+        try:
+            if os.stat(obj).st_nlink == 1:
+                os.unlink(obj)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def reserve(self, file_or_name, file_name=None, mime=None, replace=False,
+                progress=None):
+        """ Enter the download into the index; the returned reservation
+        puts the data in place.
+
+        With replace, an existing file of the same name keeps being
+        served until the new one is renamed over it.
+        """
+        if isinstance(file_or_name, basestring):
+            size = os.stat(file_or_name).st_size
+            file_name = file_name or os.path.basename(file_or_name)
+        else:
+            size = remaining_size(file_or_name)
+        if not file_name or "/" in file_name or file_name.startswith("."):
+            raise DownloadsException("Must provide a valid file name")
+        with self.metrics.request("POST index"):
+            j, replaced = self._locked(self._reserve, file_name, size, mime,
+                                       replace)
+        return LocalReservation(self, j, replaced, file_or_name, progress)
+
+    def resume(self, checkpoint, file_or_name, progress=None):
+        """ Make the reservation of checkpoint() again, in another run. """
+        j = checkpoint["j"]
+        with self.metrics.request("GET index"):
+            index = self._read_index()
+        if not [d for d in index["downloads"] if d["id"] == j["id"]]:
+            raise DownloadsException("reservation gone: %s" % j["name"])
+        return LocalReservation(self, j, checkpoint["replaced"], file_or_name,
+                                progress)
+
+    def _reserve(self, index, name, size, mime, replace):
+        downloads = index["downloads"]
+        replaced = None
+        for i, d in enumerate(downloads):
+            if d["name"] == name:
+                if not replace:
+                    raise DownloadsException("already_exists: %s" % name)
+                replaced = downloads.pop(i)
+                break
+        j = self._entry(index["next_id"], name, size, mime)
+        index["next_id"] += 1
+        downloads.insert(0, j)
+        return True, (j, replaced)
+
+    def _restore(self, index, j, replaced):
+        """ Put the entry j replaced back in its place, after j's
+        transfer failed; unless j was replaced or deleted meanwhile. """
+        downloads = index["downloads"]
+        for i, d in enumerate(downloads):
+            if d["id"] == j["id"]:
+                if d.get("object"):
+                    return False, None
+                downloads[i] = replaced
+                return True, None
+        return False, None
+
+    def _set_object(self, index, j, object):
+        """ Record object as the data of j; j is entered again if its
+        failed transfer put the entry it replaced back meanwhile.
+        Returns the object of that entry. """
+        downloads = index["downloads"]
+        for d in downloads:
+            if d["id"] == j["id"]:
+                d["object"] = object
+                return None
+        replaced = None
+        for i, d in enumerate(downloads):
+            if d["name"] == j["name"]:
+                replaced = downloads.pop(i).get("object")
+                break
+        downloads.insert(0, dict(j, object=object))
+        return replaced
+
+    def upload(self, file_or_name, file_name=None, mime=None, replace=False,
+               progress=None):
+        return self.reserve(file_or_name,
+                            file_name,
+                            mime=mime,
+                            replace=replace,
+                            progress=progress
+                            ).transfer()
+
+    def _publish(self, j, replaced, fo, progress):
+        """ Store the data of fo as an object and link it in as j's name. """
+        size = j["size"]
+        fd, tmp = tempfile.mkstemp(prefix=".incoming", dir=self.objects)
+        os.fchmod(fd, self.mode)
+        try:
+            sha = hashlib.sha1()
+            sent = 0
+            started = time.time()
+            with os.fdopen(fd, "wb") as out:
+                while sent < size:
+                    chunk = fo.read(min(self.chunk_size, size - sent))
+                    if not chunk:
+                        raise DownloadsException("File shrank while publishing")
+                    sha.update(chunk)
+                    out.write(chunk)
+                    sent += len(chunk)
+                    if progress:
+                        progress(sent, size, time.time() - started)
+                out.flush()
+                os.fsync(out.fileno())
+            self.metrics.count("bytes_sent", size)
+            self._locked(self._link, j, replaced, tmp, sha.hexdigest())
+            tmp = None
+        finally:
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def _link(self, index, j, replaced, tmp, object):
+        """ Move tmp into the store as object, link that in as j's name
+        and release the replaced object. """
+        obj = os.path.join(self.objects, object)
+        if os.path.exists(obj):
+            self.metrics.count("dedup_hits")
+            os.unlink(tmp)
+        else:
+            os.rename(tmp, obj)
+
+        fd, link = tempfile.mkstemp(prefix="." + j["name"], dir=self.root)
+        os.close(fd)
+        os.unlink(link)
+        try:
+            os.link(obj, link)
+        except AttributeError:
+            shutil.copyfile(obj, link)
+        except OSError, e:
+            # no hard links on this filesystem, or to this object
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copyfile(obj, link)
+        os.rename(link, os.path.join(self.root, j["name"]))
+        # rename() does nothing if both are links to the same object
+        if os.path.lexists(link):
+            os.unlink(link)
+        for old in (replaced and replaced.get("object"),
+                    self._set_object(index, j, object)):
+            if old != object:
+                self._release(old)
+        return True, None
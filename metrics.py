@@ -0,0 +1,235 @@
+""" Stage timings, counters and request latencies for nightly runs.
+
+Example:
+
+from metrics import Metrics
+m = Metrics()
+with m.stage("compress"):
+    ...
+m.count("bytes_read", 1234)
+m.write_json("nightly-metrics.json")
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__all__ = ["Metrics", "NullMetrics"]
+
+# clockid_t of the calling thread's CPU time on Linux
+CLOCK_THREAD_CPUTIME_ID = 3
+
+_thread_clock = None
+
+def cpu_time():
+    """ User plus system CPU time of the whole process, in seconds. """
+    if resource is not None:
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        return ru.ru_utime + ru.ru_stime
+    return time.clock()
+
+def thread_cpu_time():
+    """ CPU time of the calling thread in seconds, or None where the
+    platform cannot tell. """
+    global _thread_clock
+    if _thread_clock is None:
+        # only set once resolved: another thread may ask meanwhile
+        clock = False
+        from _sysutil import libc, libc_function
+        if libc() is not None:
+            import ctypes
+
+            class timespec(ctypes.Structure):
+                _fields_ = [("tv_sec", ctypes.c_long),
+                            ("tv_nsec", ctypes.c_long)]
+            fn = libc_function("clock_gettime", ctypes.c_int, ctypes.c_int,
+                               ctypes.POINTER(timespec))
+            if fn is not None:
+                clock = fn, timespec
+        _thread_clock = clock
+    if not _thread_clock:
+        return None
+    fn, timespec = _thread_clock
+    ts = timespec()
+    if fn(CLOCK_THREAD_CPUTIME_ID, ts) != 0:
+        return None
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+def peak_rss():
+    """ Peak resident set size of the process in bytes, or None. """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return rss
+    return rss * 1024
+
+class Metrics(object):
+    """ Collects per-stage wall and CPU time, counters and request latencies.
+
+    Stages may nest and may run on several threads at once; the CPU time
+    of a stage is that of the thread running it.  Where threads cannot
+    be told apart, only stages on the main thread get CPU time, and
+    theirs includes that of the other threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.requests = {}
+        # thread ident -> stack of stage names currently running there
+        self.active = {}
+
+    @contextmanager
+    def stage(self, name):
+        ident = threading.current_thread().ident
+        with self.lock:
+            self.active.setdefault(ident, []).append(name)
+        clock = thread_cpu_time
+        if clock() is None:
+            clock = None
+            if isinstance(threading.current_thread(), threading._MainThread):
+                clock = cpu_time
+        wall, cpu = time.time(), clock and clock()
+        try:
+            yield
+        finally:
+            wall, cpu = time.time() - wall, clock and clock() - cpu or 0.0
+            with self.lock:
+                stack = self.active[ident]
+                stack.pop()
+                if not stack:
+                    del self.active[ident]
+                s = self.stages.setdefault(name,
+                                           {"count": 0, "wall": 0.0, "cpu": 0.0})
+                s["count"] += 1
+                s["wall"] += wall
+                s["cpu"] += cpu
+
+    def current_stage(self, ident):
+        """ Innermost stage running on the given thread, or None. """
+        with self.lock:
+            stack = self.active.get(ident)
+            return stack and stack[-1] or None
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def request(self, endpoint):
+        """ Time one request against endpoint, counting failures too. """
+        started = time.time()
+        failed = False
+        try:
+            yield
+        except:
+            failed = True
+            raise
+        finally:
+            elapsed = time.time() - started
+            with self.lock:
+                r = self.requests.setdefault(endpoint,
+                                             {"count": 0, "errors": 0,
+                                              "total": 0.0, "max": 0.0})
+                r["count"] += 1
+                r["total"] += elapsed
+                r["max"] = max(r["max"], elapsed)
+                if failed:
+                    r["errors"] += 1
+
+    def to_dict(self):
+        with self.lock:
+            return {"started": self.started,
+                    "wall": time.time() - self.started,
+                    "peak_rss": peak_rss(),
+                    "stages": dict((k, dict(v)) for k, v in self.stages.items()),
+                    "counters": dict(self.counters),
+                    "requests": dict((k, dict(v)) for k, v in self.requests.items())
+                    }
+
+    def write_json(self, filename):
+        """ Write all metrics as JSON.
+
+        filename is passed through strftime, so a pattern such as
+        'metrics-%Y%m%d-%H%M.json' keeps one file per run.
+        """
+        filename = time.strftime(filename, time.localtime(self.started))
+        with open(filename, "wb") as fp:
+            json.dump(self.to_dict(), fp, indent=2, sort_keys=True)
+        return filename
+
+    def _samples(self, prefix):
+        d = self.to_dict()
+        yield "%s_wall_seconds" % prefix, None, d["wall"]
+        if d["peak_rss"] is not None:
+            yield "%s_peak_rss_bytes" % prefix, None, d["peak_rss"]
+        for name, s in sorted(d["stages"].items()):
+            yield "%s_stage_wall_seconds" % prefix, ("stage", name), s["wall"]
+            yield "%s_stage_cpu_seconds" % prefix, ("stage", name), s["cpu"]
+        for name, value in sorted(d["counters"].items()):
+            yield "%s_%s" % (prefix, name), None, value
+        for name, r in sorted(d["requests"].items()):
+            label = ("endpoint", name)
+            yield "%s_requests_total" % prefix, label, r["count"]
+            yield "%s_request_errors_total" % prefix, label, r["errors"]
+            yield "%s_request_seconds_total" % prefix, label, r["total"]
+            yield "%s_request_seconds_max" % prefix, label, r["max"]
+
+    def write_textfile(self, filename, prefix="nightly"):
+        """ Write metrics in the Prometheus text exposition format.
+
+        The file is replaced atomically, as the node exporter textfile
+        collector may read it at any time.
+        """
+        lines = []
+        for name, label, value in self._samples(prefix):
+            if label:
+                name = '%s{%s="%s"}' % (name, label[0], label[1])
+            lines.append("%s %s\n" % (name, repr(float(value))))
+        tmp = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmp, "wb") as fp:
+            fp.writelines(lines)
+        os.rename(tmp, filename)
+
+    def send_statsd(self, address, prefix="nightly"):
+        """ Send metrics as statsd gauges to a 'host:port' address. """
+        import socket
+        host, port = address.rsplit(":", 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for name, label, value in self._samples(prefix):
+                if label:
+                    name = "%s.%s" % (name, label[1].replace(" ", "_")
+                                                   .replace(".", "_")
+                                                   .replace(":", "_")
+                                                   .replace("/", "_"))
+                sock.sendto("%s:%s|g" % (name, value), (host, int(port)))
+        finally:
+            sock.close()
+
+class NullMetrics(object):
+    """ Drop-in for Metrics that records nothing. """
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def count(self, name, value=1):
+        pass
+
+    @contextmanager
+    def request(self, endpoint):
+        yield
+
+    def current_stage(self, ident):
+        return None
@@ -1,29 +1,548 @@
-import os, sys, re
+import os, sys
 import datetime
-import hashlib
+import stat
+import zlib
 
 from ConfigParser import SafeConfigParser
-from glob import glob
 from io import BytesIO
-from time import strftime
+from time import localtime, strftime
 from xml.dom.minidom import parse as XML
-from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED, ZIP64_LIMIT
 
 
 from path import path
 
-from githubdownloads import Downloads as GHDownloads
+from metrics import Metrics, NullMetrics
+from retention import RetentionPolicy, parse_size
+from xpilayout import order, read_profile
+
+# The download backends and the artifact store are imported when
+# needed: the GitHub one pulls in the whole network stack, which a dry
+# run or a bad command line should not pay for.
 
 class ZipOutFile(ZipFile):
-    def __init__(self, zfile):
+    """ A ZipFile for writing that reads every source file in one pass.
+
+    Files of at least mmap_threshold bytes are mapped, and the CRC and
+    the compressor run over slices of the mapping, without copying it
+    into strings; smaller ones are read whole.
+    """
+    mmap_threshold = 1 << 20
+    chunk_size = 1 << 20
+
+    def __init__(self, zfile, mmap_threshold=None):
         ZipFile.__init__(self, zfile, "w", ZIP_DEFLATED)
+        if mmap_threshold is not None:
+            self.mmap_threshold = mmap_threshold
+        self.mapped = 0
     def __enter__(self):
         return self
     def __exit__(self, type, value, traceback):
         self.close()
 
+    def write(self, filename, arcname=None, compress_type=None):
+        st = os.stat(filename)
+        if stat.S_ISDIR(st.st_mode):
+            return ZipFile.write(self, filename, arcname, compress_type)
+        if not self.fp:
+            raise RuntimeError(
+                  "Attempt to write to ZIP archive that was already closed")
+
+        if arcname is None:
+            arcname = filename
+        arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+        while arcname[0] in (os.sep, os.altsep):
+            arcname = arcname[1:]
+        zinfo = ZipInfo(arcname, localtime(st.st_mtime)[0:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L
+        if compress_type is None:
+            zinfo.compress_type = self.compression
+        else:
+            zinfo.compress_type = compress_type
+        zinfo.file_size = st.st_size
+        zinfo.flag_bits = 0x00
+        zinfo.header_offset = self.fp.tell()
+        self._writecheck(zinfo)
+        self._didModify = True
+
+        with open(filename, "rb") as fp:
+            if st.st_size and st.st_size >= self.mmap_threshold:
+                import mmap
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                self.mapped += 1
+            else:
+                data = fp.read()
+            try:
+                self._write_data(zinfo, data)
+            finally:
+                if not isinstance(data, str):
+                    data.close()
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+    def _write_data(self, zinfo, data):
+        # sizes and CRC are only known afterwards; the header is
+        # written again once they are
+        zip64 = self._allowZip64 and zinfo.file_size * 1.05 > ZIP64_LIMIT
+        zinfo.CRC = 0
+        zinfo.compress_size = 0
+        self.fp.write(zinfo.FileHeader(zip64))
+        cmpr = None
+        if zinfo.compress_type == ZIP_DEFLATED:
+            cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                    zlib.DEFLATED, -15)
+        crc = 0
+        compress_size = 0
+        size = len(data)
+        if isinstance(data, str) and size <= self.chunk_size:
+            chunks = [data]
+        else:
+            chunks = [buffer(data, offset, self.chunk_size)
+                      for offset in xrange(0, size, self.chunk_size)]
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            if cmpr:
+                chunk = cmpr.compress(chunk)
+            compress_size += len(chunk)
+            self.fp.write(chunk)
+        if cmpr:
+            chunk = cmpr.flush()
+            compress_size += len(chunk)
+            self.fp.write(chunk)
+        zinfo.CRC = crc & 0xffffffff
+        zinfo.file_size = size
+        zinfo.compress_size = compress_size
+        if not zip64 and self._allowZip64:
+            if size > ZIP64_LIMIT:
+                raise RuntimeError("File size has increased during compressing")
+            if compress_size > ZIP64_LIMIT:
+                raise RuntimeError("Compressed size larger than uncompressed size")
+        position = self.fp.tell()
+        self.fp.seek(zinfo.header_offset, 0)
+        self.fp.write(zinfo.FileHeader(zip64))
+        self.fp.seek(position, 0)
+
 KEYS = ["user", "pass", "repo", "extension", "dirname", "hashalgo"]
-CKEYS = ["altupdateurl", "altupdatepath", "versionextra"]
+# not required when publishing locally
+GHKEYS = ["user", "pass", "repo"]
+CKEYS = ["altupdateurl", "altupdatepath", "versionextra",
+         "metrics", "metricstextfile", "statsd", "api",
+         "keeplast", "maxage", "maxbytes", "localroot", "localurl",
+         "store", "storemaxbytes", "layout", "layoutprofile", "checkpoint",
+         "mmapthreshold"]
+# a checkpoint is only resumed by a run that agrees on these
+RUNKEYS = ["extension", "dirname", "versionextra", "hashalgo",
+           "altupdateurl", "altupdatepath", "repo", "api",
+           "localroot", "localurl", "layout", "layoutprofile"]
+LAYOUTS = ["startup", "walk"]
+
+def retention_policy(config):
+    """ The RetentionPolicy configured by keeplast, maxage (days) and
+    maxbytes; without any of them, nightlies are kept for about a month.
+    """
+    policy = RetentionPolicy()
+    if config["keeplast"]:
+        policy.keep_last = int(config["keeplast"])
+    if config["maxage"]:
+        policy.max_age = datetime.timedelta(float(config["maxage"]))
+    if config["maxbytes"]:
+        policy.max_bytes = parse_size(config["maxbytes"])
+    if (policy.keep_last is None and policy.max_age is None
+        and policy.max_bytes is None):
+        policy.max_age = datetime.timedelta(365/12)
+    return policy
+
+def clean_downloads(downloads, policy, metrics):
+    """ Delete the nightlies policy does not retain. """
+    with metrics.stage("cleanup"):
+        # plan from one complete listing, then delete
+        for df in policy.plan(downloads.iter_list()):
+            downloads.delete(df.id)
+
+def stamp(config, dom, updaterdf):
+    """ Stamp the nightly version and update URL into install.rdf and
+    mirror version and target applications into updaterdf.
+
+    Returns the version and the update node of updaterdf.
+    """
+    # Set up update.rdf extid
+    un = updaterdf.getElementsByTagName("RDF:Description")[0]
+    vn = dom.getElementsByTagName("em:id")[0]
+    un.setAttribute("about",
+                    ("urn:mozilla:extension:%s" %
+                     vn.firstChild.data
+                     )
+                    )
+
+    # Set up the version
+    vn = dom.getElementsByTagName("em:version")[0].firstChild
+    version = vn.data + "." + strftime("%Y%m%d.%H%M")
+    if config["versionextra"]:
+        version += "." + config["versionextra"]
+    vn.data = version
+
+    # Set up update.rdf version
+    un = updaterdf.getElementsByTagName("em:version")[0]
+    un.firstChild.data = version
+
+    # Set up update.rdf target application
+    un = un.parentNode
+    for n in dom.getElementsByTagName("em:targetApplication"):
+        nn = n.cloneNode(True)
+        for nd in nn.getElementsByTagName("Description"):
+            nd.tagName = "RDF:Description"
+        un.appendChild(nn)
+
+    # Get the update info in order
+    for n in dom.getElementsByTagName("em:updateKey"):
+        n.parentNode.removeChild(n)
+    try:
+        n = dom.getElementsByTagName("em:updateURL")[0]
+        while n.firstChild:
+            n.removeChild(n.firstChild)
+    except:
+        n = dom.createElement("em:updateURL")
+        un.appendChild(n)
+    if config["altupdateurl"]:
+        update_url = config["altupdateurl"]
+    elif config["localroot"]:
+        update_url = "%s/update-nightly.rdf" % config["localurl"].rstrip("/")
+    else:
+        update_url = "https://github.com/downloads/%s/update-nightly.rdf" % config["repo"]
+    n.appendChild(dom.createTextNode(update_url))
+    return version, un
+
+def stamped_install_rdf(config, dirname, updaterdf):
+    """ Return the stamped install.rdf data, the version and the update
+    node of updaterdf; see stamp(). """
+    with open(dirname / "install.rdf") as domp:
+        dom = XML(domp)
+    version, un = stamp(config, dom, updaterdf)
+    return dom.toxml(encoding="utf-8"), version, un
+
+def build(config, updaterdf, metrics):
+    """ Package the extension and stamp the update manifest.
+
+    The layout config key picks the order of the entries: 'startup'
+    (the default) writes install.rdf and the other files needed at
+    startup first, then those of the layoutprofile access-order profile,
+    then the rest grouped by directory; 'walk' writes them in the order
+    they are found, install.rdf last.
+
+    Source files of at least mmapthreshold bytes (default 1M) are
+    mapped rather than read; see ZipOutFile.
+
+    Returns the XPI data, the nightly version and the update node of
+    updaterdf, which still needs the hash and the link.
+    """
+    layout = config["layout"] or "startup"
+    if layout not in LAYOUTS:
+        raise Exception("Unknown layout: %s" % layout)
+    mmap_threshold = None
+    if config["mmapthreshold"]:
+        mmap_threshold = parse_size(config["mmapthreshold"])
+    out = BytesIO()
+    with ZipOutFile(out, mmap_threshold) as zp:
+        dirname = path(config["dirname"]).expanduser()
+        with metrics.stage("walk"):
+            files = [(f[len(dirname) + 1:].replace(os.sep, "/"), f)
+                     for f in dirname.walk()
+                     if not f.isdir() and f.basename() != "install.rdf"]
+
+        if layout == "startup":
+            with metrics.stage("manifest"):
+                install_rdf, version, un = stamped_install_rdf(config,
+                                                               dirname,
+                                                               updaterdf)
+                zp.writestr("install.rdf", install_rdf)
+                profile = None
+                if config["layoutprofile"]:
+                    profile = read_profile(
+                        path(config["layoutprofile"]).expanduser())
+                files = dict(files)
+                files = [(zf, files[zf]) for zf in order(files, profile)]
+
+        with metrics.stage("compress"):
+            for zf, f in files:
+                if zf.endswith(".png"):
+                    zp.write(f, zf, compress_type=ZIP_STORED)
+                else:
+                    zp.write(f, zf)
+                zi = zp.filelist[-1]
+                metrics.count("files")
+                metrics.count("bytes_read", zi.file_size)
+                metrics.count("bytes_compressed", zi.compress_size)
+            metrics.count("files_mapped", zp.mapped)
+
+        if layout == "walk":
+            with metrics.stage("manifest"):
+                install_rdf, version, un = stamped_install_rdf(config,
+                                                               dirname,
+                                                               updaterdf)
+                zp.writestr("install.rdf", install_rdf)
+
+    metrics.count("xpi_bytes", out.tell())
+    out.seek(0)
+    return out, version, un
+
+def finish_update_rdf(config, updaterdf, un, data, download_url, metrics):
+    """ Add the hash of the XPI data and its link to update node un,
+    and return updaterdf rendered. """
+    import hashlib
+
+    with metrics.stage("hash"):
+        hash = updaterdf.createElement("em:updateHash")
+        sum = hashlib.new(config["hashalgo"])
+        sum.update(data)
+        sum = "%s:%s" % (config["hashalgo"],
+                         sum.hexdigest()
+                         )
+        hash.appendChild(updaterdf.createTextNode(sum))
+
+    with metrics.stage("manifest"):
+        link = updaterdf.createElement("em:updateLink")
+        link.appendChild(updaterdf.createTextNode(download_url))
+
+        for nt in un.getElementsByTagName("em:targetApplication"):
+            for n in nt.getElementsByTagName("RDF:Description"):
+                n.appendChild(hash.cloneNode(True))
+                n.appendChild(link.cloneNode(True))
+
+        return updaterdf.toxml(encoding="utf-8")
+
+def xpi_name(config, version):
+    return "%s-nightly-%s.xpi" % (config["extension"], version)
+
+def read_update_rdf(nightlydir, metrics):
+    with metrics.stage("manifest"):
+        with open(nightlydir / "update-nightly.rdf") as domp:
+            return XML(domp)
+
+def dry_run(nightlydir, config, metrics):
+    """ Build the nightly and its update.rdf, but publish nothing.
+
+    No download backend is contacted; the update link is the one the
+    XPI would get.  Returns the XPI name, its data and the update.rdf.
+    """
+    updaterdf = read_update_rdf(nightlydir, metrics)
+    out, version, un = build(config, updaterdf, metrics)
+    outfile = xpi_name(config, version)
+    if config["localroot"]:
+        url = "%s/%s" % (config["localurl"].rstrip("/"), outfile)
+    else:
+        url = "https://github.com/downloads/%s/%s" % (config["repo"], outfile)
+    updaterdf = finish_update_rdf(config, updaterdf, un, out.getvalue(), url,
+                                  metrics)
+    return outfile, out, updaterdf
+
+def checkpoint_key(config):
+    """ What a run must share with the one it resumes. """
+    import json
+
+    return json.dumps([config[k] for k in RUNKEYS])
+
+def open_checkpoint(config):
+    from checkpoint import Checkpoint, NullCheckpoint
+
+    if not config["checkpoint"]:
+        return NullCheckpoint()
+    return Checkpoint(config["checkpoint"], checkpoint_key(config))
+
+def update_node(updaterdf):
+    """ The update node of a stamped updaterdf, as stamp() returns it. """
+    return updaterdf.getElementsByTagName("em:version")[0].parentNode
+
+def resume_or_reserve(checkpoint, stage, downloads, file_or_name, file_name,
+                      mime=None):
+    """ The reservation recorded for stage, or a new one.
+
+    Returns the reservation and whether it was recorded.
+    """
+    from githubdownloads import DownloadsException
+
+    if checkpoint.get(stage):
+        try:
+            return downloads.resume(checkpoint.get(stage), file_or_name), True
+        except DownloadsException:
+            pass
+    r = downloads.reserve(file_or_name, file_name, mime=mime, replace=True)
+    checkpoint.commit(**{stage: r.checkpoint()})
+    return r, False
+
+def send(checkpoint, stage, transfer, resumed):
+    """ Call transfer, which sends the data of the reservation of stage. """
+    try:
+        transfer()
+    except Exception:
+        # the next run reserves afresh, in case the old one expired
+        if resumed:
+            checkpoint.commit(**{stage: None})
+        raise
+
+def publish(nightlydir, config, metrics):
+    """ Build the nightly and publish it along with its update.rdf.
+
+    With a checkpoint directory configured, a run that failed is
+    resumed: what it built, reserved or sent already is reused.
+    """
+    from githubdownloads import Task
+
+    checkpoint = open_checkpoint(config)
+    dirname = path(config["dirname"]).expanduser()
+    if checkpoint.get("built") and checkpoint.tree_changed(dirname):
+        checkpoint.clear()
+    if checkpoint.get("built"):
+        metrics.count("resumed")
+
+    downloads = make_downloads(config, metrics)
+
+    # clean up on a worker while packaging; join before uploading
+    cleanup = None
+    if not checkpoint.get("cleaned"):
+        cleanup = Task(clean_downloads, downloads, retention_policy(config),
+                       metrics)
+        cleanup.start()
+    try:
+        if checkpoint.get("built"):
+            version = checkpoint.get("version")
+            with metrics.stage("manifest"):
+                updaterdf = XML(BytesIO(checkpoint.read("update-stamped.rdf")))
+                un = update_node(updaterdf)
+        else:
+            updaterdf = read_update_rdf(nightlydir, metrics)
+            checkpoint.put_tree(dirname)
+            out, version, un = build(config, updaterdf, metrics)
+            # kept as it is unless the checkpoint writes it to disk
+            checkpoint.commit({"nightly.xpi": out,
+                               "update-stamped.rdf":
+                               updaterdf.toxml(encoding="utf-8")},
+                              built=True, version=version)
+    finally:
+        if cleanup:
+            cleanup.join()
+    if cleanup:
+        cleanup.result()
+        checkpoint.commit(cleaned=True)
+
+    outfile = xpi_name(config, version)
+
+    # create the new file, and stream it while finishing update.rdf
+    with metrics.stage("reserve"):
+        xpi, resumed = resume_or_reserve(checkpoint, "xpi", downloads,
+                                         checkpoint.source("nightly.xpi"),
+                                         outfile,
+                                         mime="application/x-xpinstall")
+    transfer = None
+    if not checkpoint.get("sent"):
+        transfer = xpi.start()
+
+    try:
+        if checkpoint.get("rendered"):
+            updaterdf = checkpoint.read("update-nightly.rdf")
+        else:
+            updaterdf = finish_update_rdf(config, updaterdf, un,
+                                          checkpoint.read("nightly.xpi"),
+                                          xpi.info.download_url, metrics)
+            checkpoint.commit({"update-nightly.rdf": updaterdf}, rendered=True)
+
+        # keep a copy for republishing, even if the upload fails
+        if config["store"] and not checkpoint.get("stored"):
+            with metrics.stage("store"):
+                store = make_store(config)
+                store.record(version,
+                             outfile,
+                             store.put(BytesIO(checkpoint.read("nightly.xpi"))),
+                             store.put(BytesIO(updaterdf)))
+            checkpoint.commit(stored=True)
+    finally:
+        if transfer:
+            transfer.join()
+    if transfer:
+        send(checkpoint, "xpi", transfer.result, resumed)
+        checkpoint.commit(sent=True)
+
+    # replace the update.rdf only once the xpi it points to is in place:
+    # replacing deletes the old one, so a failed upload must leave it
+    if config["altupdatepath"]:
+        put_update_rdf(config, None, updaterdf)
+    else:
+        with metrics.stage("reserve"):
+            rdf, rdf_resumed = resume_or_reserve(
+                checkpoint, "rdf", downloads,
+                checkpoint.source("update-nightly.rdf"),
+                "update-nightly.rdf")
+        send(checkpoint, "rdf", rdf.transfer, rdf_resumed)
+    checkpoint.clear()
+
+def republish(config, version, metrics):
+    """ Publish a stored nightly again, without building anything.
+
+    version may also be 'latest' or 'previous', the latter being a
+    rollback to the nightly before the last one.
+    """
+    store = make_store(config)
+    entry = store.get(version)
+    downloads = make_downloads(config, metrics)
+    with open(store.path(entry["rdf"]), "rb") as fp:
+        updaterdf = fp.read()
+    with metrics.stage("reserve"):
+        xpi = downloads.reserve(store.path(entry["xpi"]),
+                                entry["xpi_name"],
+                                mime="application/x-xpinstall",
+                                replace=True)
+    xpi.transfer()
+    # as in publish(), the old update.rdf stays until the xpi is in place
+    rdf = reserve_update_rdf(config, downloads, updaterdf, metrics)
+    put_update_rdf(config, rdf, updaterdf)
+    return entry["version"]
+
+def make_store(config):
+    from artifactstore import ArtifactStore
+
+    max_bytes = None
+    if config["storemaxbytes"]:
+        max_bytes = parse_size(config["storemaxbytes"])
+    return ArtifactStore(path(config["store"]).expanduser(), max_bytes)
+
+def make_downloads(config, metrics):
+    if config["localroot"]:
+        from localdownloads import LocalDownloads
+        return LocalDownloads(path(config["localroot"]).expanduser(),
+                              config["localurl"],
+                              metrics=metrics
+                              )
+    from githubdownloads import Downloads, GITHUB_API
+    return Downloads(repo=config["repo"],
+                     user=config["user"],
+                     password=config["pass"],
+                     metrics=metrics,
+                     api=config["api"] or GITHUB_API
+                     )
+
+def reserve_update_rdf(config, downloads, updaterdf, metrics):
+    if config["altupdatepath"]:
+        return None
+    with metrics.stage("reserve"):
+        return downloads.reserve(BytesIO(updaterdf),
+                                 "update-nightly.rdf",
+                                 replace=True
+                                 )
+
+def put_update_rdf(config, rdf, updaterdf):
+    if rdf:
+        rdf.transfer()
+    else:
+        # clients may fetch it at any time; never let them see half of it
+        path(config["altupdatepath"]).expanduser().write_bytes(updaterdf,
+                                                               atomic=True)
+
+def export_metrics(config, metrics):
+    if config["metrics"]:
+        metrics.write_json(path(config["metrics"]).expanduser())
+    if config["metricstextfile"]:
+        metrics.write_textfile(path(config["metricstextfile"]).expanduser())
+    if config["statsd"]:
+        metrics.send_statsd(config["statsd"])
 
 def main():
     nightlydir = path(__file__).dirname()
@@ -38,6 +557,48 @@ def main():
     parser.add_option("--hashalgo")
     parser.add_option("--altupdateurl")
     parser.add_option("--altupdatepath")
+    parser.add_option("--api",
+                      help="GitHub API base URL")
+    parser.add_option("--localroot",
+                      help="Publish into this directory instead of GitHub")
+    parser.add_option("--localurl",
+                      help="URL the localroot directory is served at")
+    parser.add_option("--store",
+                      help="Keep every built nightly in this artifact store")
+    parser.add_option("--storemaxbytes",
+                      help="Evict the oldest stored nightlies beyond this size")
+    parser.add_option("--checkpoint",
+                      metavar="DIR",
+                      help="Record the finished stages of a run in DIR, and resume from them")
+    parser.add_option("--dry-run",
+                      action="store_true",
+                      help="Only build the nightly and its update.rdf")
+    parser.add_option("--republish",
+                      metavar="VERSION",
+                      help="Publish VERSION (or latest, previous) from the store again")
+    parser.add_option("--layout",
+                      help="Order of the XPI entries: %s (default startup)"
+                      % ", ".join(LAYOUTS))
+    parser.add_option("--layoutprofile",
+                      help="Access-order profile for the startup layout")
+    parser.add_option("--mmapthreshold",
+                      help="Map source files of at least this size, e.g. 4M, "
+                      "instead of reading them (default 1M)")
+    parser.add_option("--keeplast",
+                      help="Keep at most this many nightlies per extension")
+    parser.add_option("--maxage",
+                      help="Delete nightlies older than this many days")
+    parser.add_option("--maxbytes",
+                      help="Keep only the newest nightlies fitting this size, e.g. 500M")
+    parser.add_option("--metrics",
+                      help="Write run metrics as JSON to this file (strftime pattern)")
+    parser.add_option("--metricstextfile",
+                      help="Write run metrics to this Prometheus textfile")
+    parser.add_option("--statsd",
+                      help="Send run metrics to this statsd host:port")
+    parser.add_option("--profile",
+                      metavar="PREFIX",
+                      help="Profile the run, writing PREFIX.pstats and PREFIX.collapsed")
 
     options, args = parser.parse_args()
 
@@ -48,141 +609,55 @@ def main():
     else:
         cf.read(nightlydir / "config.ini")
     config = dict()
-    for k in KEYS:
+    for k in CKEYS:
         try:
             config[k] = getattr(options, k) or cf.get("github", k)
         except:
             config[k] = None
-
-        if not config[k]:
-            raise Exception("Not all required config keys specified: " + k)
-    for k in CKEYS:
+    for k in KEYS:
         try:
             config[k] = getattr(options, k) or cf.get("github", k)
         except:
             config[k] = None
 
-    with open(nightlydir / "update-nightly.rdf") as domp:
-        updaterdf = XML(domp)
-
-    version = None
-    out = BytesIO()
-    with ZipOutFile(out) as zp:
-        dirname = path(config["dirname"]).expanduser()
-        for f in dirname.walk():
-            if f.isdir() or f.basename() == "install.rdf":
-                continue
-            zf = f[len(dirname) + 1:]
-            if zf.endswith(".png"):
-                zp.write(f, zf, compress_type=ZIP_STORED)
-            else:
-                zp.write(f, zf)
-
-        with open(dirname / "install.rdf") as domp:
-            dom = XML(domp)
-
-        # Set up update.rdf extid
-        un = updaterdf.getElementsByTagName("RDF:Description")[0]
-        vn = dom.getElementsByTagName("em:id")[0]
-        un.setAttribute("about",
-                        ("urn:mozilla:extension:%s" %
-                         vn.firstChild.data
-                         )
-                        )
-
-        # Set up the version
-        vn = dom.getElementsByTagName("em:version")[0].firstChild
-        version = vn.data + "." + strftime("%Y%m%d.%H%M")
-        if config["versionextra"]:
-            version += "." + config["versionextra"]
-        vn.data = version
-
-        # Set up update.rdf version
-        un = updaterdf.getElementsByTagName("em:version")[0]
-        un.firstChild.data = version
-
-        # Set up update.rdf target application
-        un = un.parentNode
-        for n in dom.getElementsByTagName("em:targetApplication"):
-            nn = n.cloneNode(True)
-            for nd in nn.getElementsByTagName("Description"):
-                nd.tagName = "RDF:Description"
-            un.appendChild(nn)
-
-        # Get the update info in order
-        for n in dom.getElementsByTagName("em:updateKey"):
-            n.parentNode.removeChild(n)
-        try:
-            n = dom.getElementsByTagName("em:updateURL")[0]
-            while n.firstChild:
-                n.removeChild(n.firstChild)
-        except:
-            n = dom.createElement("em:updateURL")
-            un.appendChild(n)
-        update_url = (config["altupdateurl"]
-                      or"https://github.com/downloads/%s/update-nightly.rdf" % config["repo"]
-                      )
-        n.appendChild(dom.createTextNode(update_url))
-
-        # write install.rdf
-        zp.writestr("install.rdf", dom.toxml(encoding="utf-8"))
-
-    out.seek(0)
-    outfile = "%s-nightly-%s.xpi" % (config["extension"], version)
-
-    downloads = GHDownloads(repo=config["repo"],
-                            user=config["user"],
-                            password=config["pass"]
-                            )
-
-    # clean up
-    cutoff = datetime.date.today() - datetime.timedelta(365/12)
-    cutoff = cutoff.strftime("%Y%m%d.%H%M")
-    for df in downloads.list():
-        m = re.search(r"nightly.*\.(\d{8})", df.name)
-        if not m or m.group(1) > cutoff:
-            continue
-        downloads.delete(df.id)
-
-    # upload the new file
-    upload = downloads.upload(
-                              out,
-                              outfile,
-                              mime="application/x-xpinstall",
-                              replace=True)
-
-    # finish update.rdf
-    hash = updaterdf.createElement("em:updateHash")
-    sum = hashlib.new(config["hashalgo"])
-    sum.update(out.getvalue())
-    sum = "%s:%s" % (config["hashalgo"],
-                     sum.hexdigest()
-                     )
-    hash.appendChild(updaterdf.createTextNode(sum))
-
-    link = updaterdf.createElement("em:updateLink")
-    link.appendChild(updaterdf.createTextNode(upload.download_url))
-
-    for nt in un.getElementsByTagName("em:targetApplication"):
-        for n in nt.getElementsByTagName("RDF:Description"):
-            n.appendChild(hash.cloneNode(True))
-            n.appendChild(link.cloneNode(True))
-
-    updaterdf = updaterdf.toxml(encoding="utf-8")
+        if not config[k] and not ((config["localroot"] or options.dry_run)
+                                  and k in GHKEYS):
+            raise Exception("Not all required config keys specified: " + k)
+    if config["localroot"] and not config["localurl"]:
+        raise Exception("Not all required config keys specified: localurl")
 
-    # put the update.rdf
-    if not "altupdatepath" in config:
-        downloads.upload(BytesIO(updaterdf),
-                         "update-nightly.rdf",
-                         replace=True
-                         )
+    if (config["metrics"] or config["metricstextfile"] or config["statsd"]
+        or options.profile):
+        metrics = Metrics()
     else:
-        with open(path(config["altupdatepath"]).expanduser(), "wb") as up:
-            up.write(updaterdf)
+        metrics = NullMetrics()
+    if options.profile:
+        from profiling import Profiler
+        profiler = Profiler(path(options.profile).expanduser(), metrics)
+    else:
+        profiler = None
+    try:
+        if profiler:
+            profiler.start()
+        try:
+            with metrics.stage("total"):
+                if options.dry_run:
+                    outfile, out, updaterdf = dry_run(nightlydir, config,
+                                                      metrics)
+                    print "%s: %d bytes, update.rdf %d bytes" % (
+                        outfile, len(out.getvalue()), len(updaterdf))
+                elif options.republish:
+                    republish(config, options.republish, metrics)
+                else:
+                    publish(nightlydir, config, metrics)
+        finally:
+            if profiler:
+                profiler.stop()
+    finally:
+        export_metrics(config, metrics)
 
     return 0
 
 if __name__ == "__main__":
     import optparse
     sys.exit(main())
-
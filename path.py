@@ -40,22 +40,16 @@ This module requires Python 2.3 or later.
 
 from __future__ import generators
 
-import sys, warnings, os, fnmatch, glob, shutil, codecs, hashlib, errno
+import sys, warnings, os, fnmatch, codecs, errno
+import stat, array, struct, thread
 
-__version__ = '2.2.2.990'
-__all__ = ['path']
+from _sysutil import Pool, libc, libc_function
 
-# Platform-specific support for path.owner
-if os.name == 'nt':
-    try:
-        import win32security
-    except ImportError:
-        win32security = None
-else:
-    try:
-        import pwd
-    except ImportError:
-        pwd = None
+# glob, shutil, hashlib, threading, Queue and ctypes are imported where
+# used, keeping 'import path' cheap for short-lived scripts.
+
+__version__ = '2.2.2.990'
+__all__ = ['path', 'TreeSnapshot', 'diff', 'GroupCommit']
 
 # Pre-2.3 support.  Are unicode filenames supported?
 _base = str
@@ -78,6 +72,227 @@ _textmode = 'U'
 if hasattr(__builtins__, 'file') and not hasattr(file, 'newlines'):
     _textmode = 'r'
 
+# Line ends left after iterlines() has folded '\r\n', '\r' etc. into
+# '\n', and those unicode.splitlines() splits on besides.
+_line_ends = frozenset(u'\n\x0b\x0c\x1c\x1d\x1e\u2029')
+
+# Kernel-side file copies, where the platform has them
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_FICLONE = 0x40049409
+_COPY_CHUNK = 1 << 30
+# errnos meaning "not here", as opposed to an actual I/O error
+_NO_KERNEL_COPY = frozenset([getattr(errno, name) for name in
+                             ('ENOSYS', 'EXDEV', 'EINVAL', 'EBADF', 'EPERM',
+                              'ENOTSUP', 'EOPNOTSUPP')
+                             if hasattr(errno, name)])
+
+# Directory listings with entry types, saving a stat per entry
+try:
+    from scandir import scandir as _scandir
+except ImportError:
+    _scandir = getattr(os, 'scandir', None)
+
+def _list_types(dirname):
+    """ Return (name, isdir) for each entry; symlinks are not dirs. """
+    if _scandir is not None:
+        return [(e.name, e.is_dir(follow_symlinks=False))
+                for e in _scandir(dirname)]
+    return [(name, stat.S_ISDIR(os.lstat(os.path.join(dirname, name)).st_mode))
+            for name in os.listdir(dirname)]
+
+def _clear_dir(dirname):
+    """ Unlink the files of a directory; returns its subdirectories and
+    (name, exc_info) of each file that could not be removed. """
+    subdirs = []
+    failures = []
+    for name, isdir in _list_types(dirname):
+        name = os.path.join(dirname, name)
+        if isdir:
+            subdirs.append(name)
+            continue
+        try:
+            os.unlink(name)
+        except OSError:
+            failures.append((name, sys.exc_info()))
+    return subdirs, failures
+
+_libc_calls = None
+_syncfs_call = None
+
+def _copy_calls():
+    """ Return copy_file_range() and sendfile() of the C library, each
+    None where missing. """
+    global _libc_calls
+    if _libc_calls is None:
+        calls = None, None
+        if libc() is not None:
+            import ctypes
+            calls = (
+                libc_function('copy_file_range', ctypes.c_ssize_t,
+                              ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                              ctypes.c_void_p, ctypes.c_size_t,
+                              ctypes.c_uint),
+                libc_function('sendfile', ctypes.c_ssize_t, ctypes.c_int,
+                              ctypes.c_int, ctypes.c_void_p,
+                              ctypes.c_size_t))
+        _libc_calls = calls
+    return _libc_calls
+
+def _syncfs():
+    """ Return syncfs() of the C library, or None where missing. """
+    global _syncfs_call
+    if _syncfs_call is None:
+        call = False
+        if libc() is not None:
+            import ctypes
+            call = libc_function('syncfs', ctypes.c_int, ctypes.c_int) or False
+        _syncfs_call = call
+    return _syncfs_call or None
+
+# --- Atomic writes
+
+_umask = None
+# thread id -> its innermost GroupCommit
+_group_commits = {}
+
+def _new_file_mode():
+    global _umask
+    if _umask is None:
+        _umask = os.umask(0)
+        os.umask(_umask)
+    return 0666 & ~_umask
+
+def _fsync_dir(dirname):
+    """ Make the entries of a directory durable, where the platform
+    allows opening directories. """
+    if os.name == 'nt':
+        return
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _replace(src, dst):
+    if os.name == 'nt' and os.path.exists(dst):
+        # no atomic replace there
+        os.remove(dst)
+    os.rename(src, dst)
+
+class GroupCommit(object):
+    """ Make the atomic writes of a with block durable together.
+
+    Atomic writes by this thread inside the block are not synced one by
+    one: when the block ends, each filesystem involved is flushed once,
+    then every file is renamed into place, then the filesystems (or
+    where syncfs() is missing, each file and directory) are flushed
+    again.  Files therefore appear only when the block ends; if it
+    raises, they are discarded.  Nested blocks join the outer one.
+
+    Example:
+
+    with GroupCommit():
+        for name, data in outputs:
+            path(name).write_bytes(data, atomic=True)
+    """
+    def __init__(self):
+        self.pending = []
+        self.outer = False
+
+    def __enter__(self):
+        ident = thread.get_ident()
+        if ident in _group_commits:
+            self.outer = True
+            return _group_commits[ident]
+        _group_commits[ident] = self
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.outer:
+            return
+        del _group_commits[thread.get_ident()]
+        pending, self.pending = self.pending, []
+        if type is not None:
+            for tmp, target in pending:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+            return
+        self._flush([tmp for tmp, target in pending])
+        for tmp, target in pending:
+            _replace(tmp, target)
+        self._flush(sorted(set([os.path.dirname(target)
+                                for tmp, target in pending])),
+                    dirs=True)
+
+    def _flush(self, names, dirs=False):
+        syncfs = _syncfs()
+        if syncfs is not None:
+            # one flush per filesystem covers all of its files
+            devices = {}
+            for name in names:
+                devices.setdefault(os.stat(name).st_dev, name)
+            names = devices.values()
+        for name in names:
+            if dirs and syncfs is None:
+                _fsync_dir(name)
+                continue
+            fd = os.open(name, os.O_RDONLY)
+            try:
+                if syncfs is not None:
+                    if syncfs(fd) != 0:
+                        import ctypes
+                        err = ctypes.get_errno()
+                        raise OSError(err, os.strerror(err), name)
+                else:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+
+def _kernel_copy(fsrc, fdst):
+    """ Copy fsrc to fdst without passing the data through userspace.
+
+    Tries a reflink, then copy_file_range(), then sendfile().  Returns
+    False, with nothing copied, if none of them works for these files.
+    """
+    src, dst = fsrc.fileno(), fdst.fileno()
+    if fcntl is not None and sys.platform.startswith('linux'):
+        try:
+            fcntl.ioctl(dst, _FICLONE, src)
+            return True
+        except (IOError, OSError):
+            pass
+    copy_file_range, sendfile = _copy_calls()
+    calls = []
+    if copy_file_range is not None:
+        calls.append(lambda n: copy_file_range(src, None, dst, None, n, 0))
+    if sendfile is not None:
+        calls.append(lambda n: sendfile(dst, src, None, n))
+    for call in calls:
+        copied = 0
+        while True:
+            n = call(_COPY_CHUNK)
+            if n == 0:
+                # nothing at all may also be a file the call can't read
+                if copied == 0:
+                    break
+                return True
+            if n < 0:
+                import ctypes
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if copied == 0 and err in _NO_KERNEL_COPY:
+                    break
+                raise OSError(err, os.strerror(err), fsrc.name)
+            copied += n
+    return False
+
 class TreeWalkWarning(Warning):
     pass
 
@@ -360,7 +575,7 @@ class path(_base):
         
         return [p for p in self.listdir(pattern) if p.isfile()]
 
-    def walk(self, pattern=None, errors='strict'):
+    def walk(self, pattern=None, errors='strict', workers=None, ordered=True):
         """ D.walk() -> iterator over files and subdirs, recursively.
 
         The iterator yields path objects naming each child item of
@@ -374,9 +589,20 @@ class path(_base):
         error occurs.  The default is 'strict', which causes an
         exception.  The other allowed values are 'warn', which
         reports the error via warnings.warn(), and 'ignore'.
+
+        With workers, up to that many directories are read at once,
+        which pays off where each listdir() or stat() waits on the
+        network.  The items come in the usual order, unless ordered
+        is false: then each directory's items come as soon as it has
+        been read, still after the directory itself.
         """
         if errors not in ('strict', 'warn', 'ignore'):
             raise ValueError("invalid errors parameter")
+        if workers:
+            for item in self._walk_concurrent('all', pattern, errors,
+                                              workers, ordered):
+                yield item
+            return
 
         try:
             childList = self.listdir()
@@ -413,7 +639,8 @@ class path(_base):
                 for item in child.walk(pattern, errors):
                     yield item
 
-    def walkdirs(self, pattern=None, errors='strict'):
+    def walkdirs(self, pattern=None, errors='strict', workers=None,
+                 ordered=True):
         """ D.walkdirs() -> iterator over subdirs, recursively.
 
         With the optional 'pattern' argument, this yields only
@@ -425,9 +652,16 @@ class path(_base):
         error occurs.  The default is 'strict', which causes an
         exception.  The other allowed values are 'warn', which
         reports the error via warnings.warn(), and 'ignore'.
+
+        workers and ordered work as for walk().
         """
         if errors not in ('strict', 'warn', 'ignore'):
             raise ValueError("invalid errors parameter")
+        if workers:
+            for item in self._walk_concurrent('dirs', pattern, errors,
+                                              workers, ordered):
+                yield item
+            return
 
         try:
             dirs = self.dirs()
@@ -449,16 +683,24 @@ class path(_base):
             for subsubdir in child.walkdirs(pattern, errors):
                 yield subsubdir
 
-    def walkfiles(self, pattern=None, errors='strict'):
+    def walkfiles(self, pattern=None, errors='strict', workers=None,
+                  ordered=True):
         """ D.walkfiles() -> iterator over files in D, recursively.
 
         The optional argument, pattern, limits the results to files
         with names that match the pattern.  For example,
         mydir.walkfiles('*.tmp') yields only files with the .tmp
         extension.
+
+        errors, workers and ordered work as for walk().
         """
         if errors not in ('strict', 'warn', 'ignore'):
             raise ValueError("invalid errors parameter")
+        if workers:
+            for item in self._walk_concurrent('files', pattern, errors,
+                                              workers, ordered):
+                yield item
+            return
 
         try:
             childList = self.listdir()
@@ -497,6 +739,100 @@ class path(_base):
                 for f in child.walkfiles(pattern, errors):
                     yield f
 
+    def snapshot(self, hash_name=None, errors='strict'):
+        """ D.snapshot() -> TreeSnapshot of everything below D.
+
+        Records the relative path, size, modification time and mode of
+        every entry, and with hash_name (e.g. 'md5') a hash of every
+        regular file.  Symbolic links are recorded, not followed.
+
+        errors= works as for walk().
+        """
+        return TreeSnapshot.from_tree(self, hash_name, errors)
+
+    def _walk_concurrent(self, kind, pattern, errors, workers, ordered):
+        """ walk(), walkdirs() or walkfiles() on a pool of threads.
+
+        In order, every directory read submits the reads of its
+        subdirectories right away, so the pool stays busy however
+        slowly the items are consumed.  Otherwise they are submitted
+        once the directory's items have been yielded, so that they
+        never come before the directory itself.
+        """
+        import Queue
+        pool = Pool(workers)
+        results = Queue.Queue()
+        stopped = []
+
+        def scan(d):
+            if stopped:
+                return None
+            try:
+                entries = []
+                for child in d.listdir():
+                    isfile = child.isfile()
+                    isdir = not isfile and child.isdir()
+                    sub = None
+                    if isdir and ordered:
+                        sub = pool.submit(scan, child)
+                    entries.append((child, isfile, isdir, sub))
+                rv = d, None, entries
+            except Exception:
+                rv = d, sys.exc_info(), None
+            if not ordered:
+                results.put(rv)
+            return rv
+
+        def wanted(child, isfile, isdir):
+            if kind == 'files' and not isfile:
+                return False
+            if kind == 'dirs' and not isdir:
+                return False
+            return pattern is None or child.fnmatch(pattern)
+
+        def listing_failed(d, exc_info):
+            if errors == 'strict':
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if errors == 'warn':
+                warnings.warn("Unable to list directory '%s': %s"
+                              % (d, exc_info[1]),
+                              TreeWalkWarning)
+
+        def visit(future):
+            d, exc_info, entries = future.result()
+            if exc_info:
+                listing_failed(d, exc_info)
+                return
+            for child, isfile, isdir, sub in entries:
+                if wanted(child, isfile, isdir):
+                    yield child
+                if sub is not None:
+                    for item in visit(sub):
+                        yield item
+
+        try:
+            root = pool.submit(scan, self)
+            if ordered:
+                for item in visit(root):
+                    yield item
+                return
+            outstanding = 1
+            while outstanding:
+                d, exc_info, entries = results.get()
+                outstanding -= 1
+                if exc_info:
+                    listing_failed(d, exc_info)
+                    continue
+                for child, isfile, isdir, sub in entries:
+                    if wanted(child, isfile, isdir):
+                        yield child
+                    if isdir:
+                        pool.submit(scan, child)
+                        outstanding += 1
+        finally:
+            stopped.append(True)
+            pool.close(cancel=True)
+
     def fnmatch(self, pattern):
         """ Return True if self.name matches the given pattern.
 
@@ -514,6 +850,7 @@ class path(_base):
         of all the files users have in their bin directories.
         """
         cls = self.__class__
+        import glob
         return [cls(s) for s in glob.glob(_base(self / pattern))]
 
 
@@ -531,21 +868,66 @@ class path(_base):
         finally:
             f.close()
 
-    def write_bytes(self, bytes, append=False):
+    def write_bytes(self, bytes, append=False, atomic=False):
         """ Open this file and write the given bytes to it.
 
         Default behavior is to overwrite any existing file.
         Call p.write_bytes(bytes, append=True) to append instead.
+
+        With atomic=True, the bytes go to a temporary file in the same
+        directory, which is synced and renamed over this one, so
+        readers see either the old or the new file, never a part of
+        it.  Inside a GroupCommit block, syncing and renaming wait for
+        the end of the block.
         """
+        self._write(lambda f: f.write(bytes), append, atomic)
+
+    def _write(self, write, append, atomic):
+        """ Call write(f) with this file opened for writing. """
+        if not atomic:
+            if append:
+                f = self.open('ab')
+            else:
+                f = self.open('wb')
+            try:
+                write(f)
+            finally:
+                f.close()
+            return
         if append:
-            mode = 'ab'
-        else:
-            mode = 'wb'
-        f = self.open(mode)
+            raise ValueError("atomic writes cannot append")
+
+        import tempfile
+        target = os.path.abspath(self)
+        dirname, name = os.path.split(target)
+        fd, tmp = tempfile.mkstemp(prefix='.%s.' % name, suffix='.tmp',
+                                   dir=dirname)
         try:
-            f.write(bytes)
+            if hasattr(os, 'fchmod'):
+                try:
+                    mode = stat.S_IMODE(os.stat(target).st_mode)
+                except OSError:
+                    mode = _new_file_mode()
+                os.fchmod(fd, mode)
+            batch = _group_commits.get(thread.get_ident())
+            f = os.fdopen(fd, 'wb')
+            try:
+                write(f)
+                f.flush()
+                if batch is None:
+                    os.fsync(f.fileno())
+            finally:
+                f.close()
+            if batch is not None:
+                batch.pending.append((tmp, target))
+                tmp = None
+                return
+            _replace(tmp, target)
+            tmp = None
+            _fsync_dir(dirname)
         finally:
-            f.close()
+            if tmp is not None:
+                os.unlink(tmp)
 
     def text(self, encoding=None, errors='strict'):
         r""" Open this file, read it in, return the content as a string.
@@ -584,7 +966,8 @@ class path(_base):
                      .replace(u'\x85', u'\n')
                      .replace(u'\u2028', u'\n'))
 
-    def write_text(self, text, encoding=None, errors='strict', linesep=os.linesep, append=False):
+    def write_text(self, text, encoding=None, errors='strict', linesep=os.linesep,
+                   append=False, atomic=False):
         r""" Write the given text to this file.
 
         The default behavior is to overwrite any existing file;
@@ -615,6 +998,9 @@ class path(_base):
             the file already exists (True: append to the end of it;
             False: overwrite it.)  The default is False.
 
+          - atomic - keyword argument - bool - Replace the file
+            atomically; see write_bytes().  The default is False.
+
 
         --- Newline handling.
 
@@ -671,7 +1057,7 @@ class path(_base):
                             .replace('\r', '\n'))
                 bytes = text.replace('\n', linesep)
 
-        self.write_bytes(bytes, append)
+        self.write_bytes(bytes, append, atomic)
 
     def lines(self, encoding=None, errors='strict', retain=True):
         r""" Open this file, read all lines, return them in a list.
@@ -697,10 +1083,76 @@ class path(_base):
             finally:
                 f.close()
         else:
-            return self.text(encoding, errors).splitlines(retain)
+            return list(self.iterlines(encoding, errors, retain))
+
+    def iterlines(self, encoding=None, errors='strict', retain=True,
+                  bufsize=65536):
+        r""" Iterate over the lines of this file.
+
+        Same arguments and lines as lines(), but the file is read and
+        decoded bufsize bytes at a time, so memory use is bounded by
+        the longest line instead of the size of the file.
+        """
+        if encoding is None:
+            decode = None
+            empty = ''
+        else:
+            decode = codecs.getincrementaldecoder(encoding)(errors).decode
+            empty = u''
+        f = self.open('rb')
+        try:
+            held = empty
+            partial = []
+            final = False
+            while not final:
+                data = f.read(bufsize)
+                final = not data
+                if decode is not None:
+                    data = decode(data, final)
+                data = held + data
+                # a trailing '\r' may be the start of '\r\n'
+                if not final and data[-1:] == '\r':
+                    held, data = data[-1:], data[:-1]
+                else:
+                    held = empty
+                if not data:
+                    continue
+                if decode is None:
+                    data = data.replace('\r\n', '\n').replace('\r', '\n')
+                    lines = data.split('\n')
+                    last = lines.pop()
+                    lines = [line + '\n' for line in lines]
+                    if last:
+                        lines.append(last)
+                    ends = '\n'
+                else:
+                    data = (data.replace(u'\r\n', u'\n')
+                                .replace(u'\r\x85', u'\n')
+                                .replace(u'\r', u'\n')
+                                .replace(u'\x85', u'\n')
+                                .replace(u'\u2028', u'\n'))
+                    lines = data.splitlines(True)
+                    ends = _line_ends
+                tail = None
+                if not final and lines[-1][-1:] not in ends:
+                    tail = lines.pop()
+                if lines and partial:
+                    partial.append(lines[0])
+                    lines[0] = empty.join(partial)
+                    partial = []
+                for line in lines:
+                    if not retain and line[-1:] in ends:
+                        line = line[:-1]
+                    yield line
+                if tail is not None:
+                    partial.append(tail)
+            if partial:
+                yield empty.join(partial)
+        finally:
+            f.close()
 
     def write_lines(self, lines, encoding=None, errors='strict',
-                    linesep=os.linesep, append=False):
+                    linesep=os.linesep, append=False, atomic=False):
         r""" Write the given lines of text to this file.
 
         By default this overwrites any existing file at this path.
@@ -732,13 +1184,11 @@ class path(_base):
         you specify with the encoding= parameter, the result is
         mixed-encoding data, which can really confuse someone trying
         to read the file later.
+
+        Use atomic=True to replace the file atomically; see
+        write_bytes().
         """
-        if append:
-            mode = 'ab'
-        else:
-            mode = 'wb'
-        f = self.open(mode)
-        try:
+        def write(f):
             for line in lines:
                 isUnicode = isinstance(line, unicode)
                 if linesep is not None:
@@ -757,12 +1207,10 @@ class path(_base):
                             line = line[:-1]
                     line += linesep
                 if isUnicode:
-                    if encoding is None:
-                        encoding = sys.getdefaultencoding()
-                    line = line.encode(encoding, errors)
+                    line = line.encode(encoding or sys.getdefaultencoding(),
+                                       errors)
                 f.write(line)
-        finally:
-            f.close()
+        self._write(write, append, atomic)
 
     def read_md5(self):
         """ Calculate the md5 hash for this file.
@@ -772,6 +1220,7 @@ class path(_base):
         return self.read_hash('md5')
 
     def _hash(self, hash_name):
+        import hashlib
         f = self.open('rb')
         try:
             m = hashlib.new(hash_name)
@@ -857,7 +1306,9 @@ class path(_base):
         On Windows, a group can own a file or directory.
         """
         if os.name == 'nt':
-            if win32security is None:
+            try:
+                import win32security
+            except ImportError:
                 raise Exception("path.owner requires win32all to be installed")
             desc = win32security.GetFileSecurity(
                 self, win32security.OWNER_SECURITY_INFORMATION)
@@ -865,7 +1316,9 @@ class path(_base):
             account, domain, typecode = win32security.LookupAccountSid(None, sid)
             return domain + u'\\' + account
         else:
-            if pwd is None:
+            try:
+                import pwd
+            except ImportError:
                 raise NotImplementedError("path.owner is not implemented on this platform.")
             st = self.stat()
             return pwd.getpwuid(st.st_uid).pw_name
@@ -1006,15 +1459,223 @@ class path(_base):
 
     # --- High-level functions from shutil
 
-    copyfile = shutil.copyfile
-    copymode = shutil.copymode
-    copystat = shutil.copystat
-    copy = shutil.copy
-    copy2 = shutil.copy2
-    copytree = shutil.copytree
-    if hasattr(shutil, 'move'):
-        move = shutil.move
-    rmtree = shutil.rmtree
+    def copyfile(self, dst):
+        """ Copy this file's data to dst, like shutil.copyfile().
+
+        The data is copied by the kernel where it can be: as a reflink
+        on filesystems that share blocks, else with copy_file_range()
+        or sendfile().  Otherwise it goes through userspace buffers.
+        """
+        import shutil
+        try:
+            same = os.path.samefile(self, dst)
+        except AttributeError:
+            same = (os.path.normcase(os.path.abspath(self)) ==
+                    os.path.normcase(os.path.abspath(dst)))
+        except OSError:
+            same = False
+        if same:
+            raise shutil.Error("`%s` and `%s` are the same file" % (self, dst))
+        for fn in (self, dst):
+            try:
+                st = os.stat(fn)
+            except OSError:
+                # dst need not exist
+                continue
+            if stat.S_ISFIFO(st.st_mode):
+                raise shutil.SpecialFileError("`%s` is a named pipe" % fn)
+        fsrc = open(self, 'rb')
+        try:
+            fdst = open(dst, 'wb')
+            try:
+                if not _kernel_copy(fsrc, fdst):
+                    shutil.copyfileobj(fsrc, fdst)
+            finally:
+                fdst.close()
+        finally:
+            fsrc.close()
+
+    def copymode(self, dst):
+        import shutil
+        shutil.copymode(self, dst)
+
+    def copystat(self, dst):
+        import shutil
+        shutil.copystat(self, dst)
+
+    def copy(self, dst):
+        """ Copy data and mode bits, like shutil.copy(). """
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, self.name)
+        self.copyfile(dst)
+        self.copymode(dst)
+
+    def copy2(self, dst):
+        """ Copy data and all stat info, like shutil.copy2(). """
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, self.name)
+        self.copyfile(dst)
+        self.copystat(dst)
+
+    def copytree(self, dst, symlinks=False, ignore=None, workers=None,
+                 skip_unchanged=False):
+        """ Recursively copy this directory to dst, like shutil.copytree().
+
+        Files are copied with copy2().  With workers, up to that many
+        files are copied at once.  With skip_unchanged, dst may already
+        exist, and files there of the same size and modification time
+        are left alone.
+
+        Errors are collected and raised together as shutil.Error.
+        """
+        import shutil
+        errors = []
+        dirs = []
+        pool = workers and Pool(workers) or None
+        pending = []
+        try:
+            self._copytree(self.__class__(dst), symlinks, ignore,
+                           skip_unchanged, pool, dirs, pending, errors)
+            for src, target, future in pending:
+                try:
+                    future.result()
+                except EnvironmentError, why:
+                    errors.append((src, target, str(why)))
+        finally:
+            if pool:
+                pool.close()
+        # only now that their files are in place
+        for src, target in reversed(dirs):
+            try:
+                shutil.copystat(src, target)
+            except OSError, why:
+                errors.append((src, target, str(why)))
+        if errors:
+            raise shutil.Error(errors)
+
+    def _copytree(self, dst, symlinks, ignore, skip_unchanged, pool, dirs,
+                  pending, errors):
+        import shutil
+        names = os.listdir(self)
+        if ignore is not None:
+            ignored = ignore(self, names)
+        else:
+            ignored = ()
+        if not (skip_unchanged and dst.isdir()):
+            os.makedirs(dst)
+        dirs.append((self, dst))
+        for name in names:
+            if name in ignored:
+                continue
+            src = self / name
+            target = dst / name
+            try:
+                if symlinks and src.islink():
+                    if skip_unchanged and target.islink():
+                        if os.readlink(target) == os.readlink(src):
+                            continue
+                        os.unlink(target)
+                    os.symlink(os.readlink(src), target)
+                elif src.isdir():
+                    src._copytree(target, symlinks, ignore, skip_unchanged,
+                                  pool, dirs, pending, errors)
+                elif skip_unchanged and src._unchanged(target):
+                    continue
+                elif pool:
+                    pending.append((src, target, pool.submit(src.copy2, target)))
+                else:
+                    src.copy2(target)
+            except shutil.Error, err:
+                errors.extend(err.args[0])
+            except EnvironmentError, why:
+                errors.append((src, target, str(why)))
+
+    def _unchanged(self, dst):
+        """ Whether dst has the size and modification time of this file. """
+        try:
+            st, dst_st = os.stat(self), os.stat(dst)
+        except OSError:
+            return False
+        return (stat.S_ISREG(dst_st.st_mode)
+                and st.st_size == dst_st.st_size
+                and int(st.st_mtime) == int(dst_st.st_mtime))
+
+    def move(self, dst):
+        import shutil
+        shutil.move(self, dst)
+
+    def rmtree(self, ignore_errors=False, onerror=None, workers=None,
+               errors='strict'):
+        """ Delete this directory tree, like shutil.rmtree().
+
+        With workers, up to that many directories are cleared at once:
+        listed, using directory entry types where the platform has
+        them, and their files unlinked.  The directories themselves are
+        removed bottom-up once empty.
+
+        In that mode the errors= keyword argument works as for walk():
+        'strict' raises the first error once everything else that can
+        be removed is gone, 'warn' reports each error via
+        warnings.warn(), and 'ignore' skips over them.  onerror, if
+        given, is called instead as for shutil.rmtree(), from the
+        calling thread, with os.listdir, os.remove or os.rmdir as the
+        function that failed.
+        """
+        if not workers:
+            import shutil
+            return shutil.rmtree(self, ignore_errors, onerror)
+        if errors not in ('strict', 'warn', 'ignore'):
+            raise ValueError("invalid errors parameter")
+        if ignore_errors:
+            errors = 'ignore'
+        if os.path.islink(self):
+            try:
+                raise OSError("Cannot call rmtree on a symbolic link")
+            except OSError:
+                if onerror is None or errors == 'ignore':
+                    raise
+                onerror(os.path.islink, self, sys.exc_info())
+                return
+
+        failures = []
+        def failed(func, what, name, exc_info):
+            if errors == 'ignore':
+                return
+            if onerror is not None:
+                onerror(func, name, exc_info)
+            elif errors == 'warn':
+                warnings.warn("Unable to %s '%s': %s"
+                              % (what, name, exc_info[1]),
+                              TreeWalkWarning)
+            elif errors == 'strict':
+                failures.append(exc_info)
+
+        dirs = []
+        pool = Pool(workers)
+        try:
+            pending = [(self, pool.submit(_clear_dir, self))]
+            while pending:
+                d, future = pending.pop(0)
+                try:
+                    subdirs, unlink_failures = future.result()
+                except OSError:
+                    failed(os.listdir, "list directory", d, sys.exc_info())
+                    continue
+                for name, exc_info in unlink_failures:
+                    failed(os.remove, "remove", name, exc_info)
+                dirs.append(d)
+                for sub in subdirs:
+                    pending.append((sub, pool.submit(_clear_dir, sub)))
+        finally:
+            pool.close()
+        # children were cleared after their parents
+        for d in reversed(dirs):
+            try:
+                os.rmdir(d)
+            except OSError:
+                failed(os.rmdir, "remove directory", d, sys.exc_info())
+        if failures:
+            raise failures[0][0], failures[0][1], failures[0][2]
 
 
     # --- Special stuff from os
@@ -1027,3 +1688,233 @@ class path(_base):
         def startfile(self):
             os.startfile(self)
 
+
+class TreeSnapshot(object):
+    """ The state of a directory tree, stored compactly.
+
+    Entries are kept sorted by (directory, name).  Each directory
+    prefix is stored once; names are packed into one string, and
+    sizes, times and modes into arrays, so a snapshot of many
+    thousand files costs a few dozen bytes per file.  Snapshots can
+    be saved to, and loaded from, a small binary file.
+    """
+    _magic = 'PATHSNP1'
+    _arrays = ('dir_index', 'name_ends', 'sizes', 'mtimes', 'modes')
+
+    def __init__(self, hash_name=None):
+        self.hash_name = hash_name
+        self.hash_size = 0
+        if hash_name:
+            import hashlib
+            self.hash_size = hashlib.new(hash_name).digest_size
+        self.dirs = []
+        self.dir_index = array.array('L')
+        self.names = ''
+        self.name_ends = array.array('L')
+        self.sizes = array.array('L')
+        self.mtimes = array.array('d')
+        self.modes = array.array('L')
+        self.hashes = ''
+
+    @classmethod
+    def from_tree(cls, top, hash_name=None, errors='strict'):
+        if errors not in ('strict', 'warn', 'ignore'):
+            raise ValueError("invalid errors parameter")
+        # names are stored as bytes
+        if isinstance(top, unicode):
+            top = top.encode(sys.getfilesystemencoding() or 'utf-8')
+        snap = cls(hash_name)
+        names = []
+        hashes = []
+        end = 0
+        todo = ['']
+        while todo:
+            rel = todo.pop()
+            d = os.path.join(top, rel)
+            try:
+                children = sorted(os.listdir(d))
+            except Exception:
+                if errors == 'strict':
+                    raise
+                if errors == 'warn':
+                    warnings.warn("Unable to list directory '%s': %s"
+                                  % (d, sys.exc_info()[1]),
+                                  TreeWalkWarning)
+                continue
+            index = len(snap.dirs)
+            snap.dirs.append(rel)
+            for name in children:
+                child = os.path.join(d, name)
+                try:
+                    st = os.lstat(child)
+                    digest = ''
+                    if hash_name and stat.S_ISREG(st.st_mode):
+                        digest = path(child)._hash(hash_name).digest()
+                except Exception:
+                    if errors == 'strict':
+                        raise
+                    if errors == 'warn':
+                        warnings.warn("Unable to access '%s': %s"
+                                      % (child, sys.exc_info()[1]),
+                                      TreeWalkWarning)
+                    continue
+                snap.dir_index.append(index)
+                names.append(name)
+                end += len(name)
+                snap.name_ends.append(end)
+                snap.sizes.append(st.st_size)
+                snap.mtimes.append(st.st_mtime)
+                snap.modes.append(st.st_mode)
+                hashes.append(digest.ljust(snap.hash_size, '\0'))
+                if stat.S_ISDIR(st.st_mode):
+                    todo.append(os.path.join(rel, name))
+        snap.names = ''.join(names)
+        snap.hashes = ''.join(hashes)
+        return snap._sorted()
+
+    def _sorted(self):
+        """ Reorder the directories by name, and the entries by
+        (directory, name), the order diff() relies on. """
+        order = sorted(range(len(self.dirs)), key=self.dirs.__getitem__)
+        renumber = [0] * len(order)
+        for new, old in enumerate(order):
+            renumber[old] = new
+        self.dirs = [self.dirs[i] for i in order]
+        entries = sorted(range(len(self)),
+                         key=lambda i: (renumber[self.dir_index[i]],
+                                        self._name(i)))
+        names = [self._name(i) for i in entries]
+        ends = array.array('L')
+        end = 0
+        for name in names:
+            end += len(name)
+            ends.append(end)
+        hs = self.hash_size
+        self.hashes = ''.join([self.hashes[i * hs:(i + 1) * hs]
+                               for i in entries])
+        self.names = ''.join(names)
+        self.name_ends = ends
+        self.dir_index = array.array('L', [renumber[self.dir_index[i]]
+                                           for i in entries])
+        for attr in ('sizes', 'mtimes', 'modes'):
+            a = getattr(self, attr)
+            setattr(self, attr, array.array(a.typecode, [a[i] for i in entries]))
+        return self
+
+    def __len__(self):
+        return len(self.name_ends)
+
+    def _name(self, i):
+        start = i and self.name_ends[i - 1] or 0
+        return self.names[start:self.name_ends[i]]
+
+    def _key(self, i):
+        return self.dirs[self.dir_index[i]], self._name(i)
+
+    def relpath(self, i):
+        """ The path of entry i, relative to the snapshot's top. """
+        d, name = self._key(i)
+        return path(os.path.join(d, name))
+
+    def hash(self, i):
+        """ The hash of entry i, or None for unhashed entries. """
+        if not self.hash_size:
+            return None
+        h = self.hashes[i * self.hash_size:(i + 1) * self.hash_size]
+        if stat.S_ISREG(self.modes[i]):
+            return h
+        return None
+
+    def __iter__(self):
+        """ Yield (relpath, size, mtime, mode, hash) for every entry. """
+        for i in xrange(len(self)):
+            yield (self.relpath(i), self.sizes[i], self.mtimes[i],
+                   self.modes[i], self.hash(i))
+
+    def save(self, filename):
+        """ Write this snapshot to a binary file. """
+        f = open(filename, 'wb')
+        try:
+            f.write(self._magic)
+            f.write(sys.byteorder[0])
+            for blob in (self.hash_name or '', '\0'.join(self.dirs),
+                         self.names, self.hashes):
+                f.write(struct.pack('<Q', len(blob)))
+                f.write(blob)
+            for attr in self._arrays:
+                a = getattr(self, attr)
+                f.write(struct.pack('<cBQ', a.typecode, a.itemsize, len(a)))
+                a.tofile(f)
+        finally:
+            f.close()
+
+    @classmethod
+    def load(cls, filename):
+        """ Read a snapshot written by save(). """
+        f = open(filename, 'rb')
+        try:
+            if f.read(len(cls._magic)) != cls._magic:
+                raise ValueError("not a tree snapshot: %s" % filename)
+            swap = f.read(1) != sys.byteorder[0]
+            blobs = []
+            for i in range(4):
+                size, = struct.unpack('<Q', f.read(8))
+                blobs.append(f.read(size))
+            snap = cls(blobs[0] or None)
+            snap.dirs = blobs[1].split('\0')
+            snap.names = blobs[2]
+            snap.hashes = blobs[3]
+            for attr in cls._arrays:
+                typecode, itemsize, count = struct.unpack('<cBQ', f.read(10))
+                a = array.array(typecode)
+                if a.itemsize != itemsize:
+                    raise ValueError("snapshot written on an incompatible "
+                                     "platform: %s" % filename)
+                a.fromfile(f, count)
+                if swap:
+                    a.byteswap()
+                setattr(snap, attr, a)
+            return snap
+        finally:
+            f.close()
+
+def diff(old, new):
+    """ Compare two TreeSnapshots of the same tree.
+
+    Yields (change, relpath) in the snapshots' (directory, name)
+    order, so the files of a directory come before those of its
+    subdirectories: 'new.txt' before 'd0/f1.txt'.  change is one of
+    'added', 'removed' or 'modified'; both are read in one pass.  An
+    entry is modified if its mode or size changed and, when both
+    snapshots hold hashes of the same kind, its hash; otherwise, if
+    its modification time changed.
+    """
+    by_hash = (old.hash_name is not None and old.hash_name == new.hash_name)
+    i = j = 0
+    n, m = len(old), len(new)
+    while i < n or j < m:
+        if j >= m:
+            yield 'removed', old.relpath(i)
+            i += 1
+            continue
+        if i >= n:
+            yield 'added', new.relpath(j)
+            j += 1
+            continue
+        a, b = old._key(i), new._key(j)
+        if a < b:
+            yield 'removed', old.relpath(i)
+            i += 1
+        elif a > b:
+            yield 'added', new.relpath(j)
+            j += 1
+        else:
+            if by_hash:
+                changed = old.hash(i) != new.hash(j)
+            else:
+                changed = old.mtimes[i] != new.mtimes[j]
+            if (changed or old.modes[i] != new.modes[j]
+                or old.sizes[i] != new.sizes[j]):
+                yield 'modified', new.relpath(j)
+            i += 1
+            j += 1
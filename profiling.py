@@ -0,0 +1,95 @@
+""" Profile a nightly run.
+
+Profiler combines cProfile, which yields an exact pstats dump for the
+thread that started it, with a sampler over all threads, which yields
+flamegraph-compatible collapsed stacks.  Each sampled stack is rooted
+at the metrics stage its thread was in, followed by 'cpu', 'net' or
+'idle' depending on the innermost frame, so time spent waiting on
+sockets or worker threads does not hide among CPU hotspots.
+
+Example:
+
+from profiling import Profiler
+with Profiler("run", metrics):
+    publish(...)
+
+writes run.pstats and run.collapsed; the latter is fed straight into
+flamegraph.pl.
+"""
+
+import cProfile
+import os
+import sys
+import threading
+
+__all__ = ["Profiler"]
+
+NET_MODULES = ("socket.py", "ssl.py", "httplib.py", "urllib2.py")
+IDLE_MODULES = ("threading.py", "Queue.py")
+
+def _frame_name(code):
+    return "%s (%s:%d)" % (code.co_name,
+                           os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+class Profiler(object):
+    def __init__(self, basename, metrics=None, interval=0.005):
+        self.basename = basename
+        self.metrics = metrics
+        self.interval = interval
+        self.samples = {}
+        self.profile = None
+        self.sampler = None
+        self.stopped = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self):
+        self.sampler = threading.Thread(target=self._sample, name="sampler")
+        self.sampler.daemon = True
+        self.sampler.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        """ Stop profiling and write the pstats and collapsed files. """
+        self.profile.disable()
+        self.stopped.set()
+        self.sampler.join()
+        self.profile.dump_stats(self.basename + ".pstats")
+        with open(self.basename + ".collapsed", "wb") as fp:
+            for stack, count in sorted(self.samples.items()):
+                fp.write("%s %d\n" % (stack, count))
+
+    def _classify(self, frame):
+        name = os.path.basename(frame.f_code.co_filename)
+        if name in NET_MODULES:
+            return "net"
+        if name in IDLE_MODULES:
+            return "idle"
+        return "cpu"
+
+    def _sample(self):
+        me = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                kind = self._classify(frame)
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stage = None
+                if self.metrics is not None:
+                    stage = self.metrics.current_stage(ident)
+                stack.append(kind)
+                stack.append(stage or "-")
+                stack.reverse()
+                key = ";".join(stack)
+                self.samples[key] = self.samples.get(key, 0) + 1
@@ -0,0 +1,98 @@
+""" Decide which nightly downloads to delete.
+
+Nightly names look like EXTENSION-nightly-VERSION.YYYYMMDD.HHMM[.EXTRA].xpi.
+RetentionPolicy indexes one listing by extension and parsed build
+timestamp, and plans all deletions up front from three limits:
+
+  keep_last - keep at most this many nightlies per extension
+  max_age   - delete nightlies older than this (a timedelta)
+  max_bytes - keep the newest nightlies, across all extensions, that
+              fit into this many bytes
+
+Downloads that do not look like nightlies are never touched.
+
+Example:
+
+from retention import RetentionPolicy
+policy = RetentionPolicy(keep_last=20, max_age=datetime.timedelta(30))
+for d in policy.plan(downloads.iter_list()):
+    downloads.delete(d.id)
+"""
+
+import datetime
+import re
+# strptime imports this on first use, which fails in a thread while
+# another one holds the import lock; cleanups run on a thread
+import _strptime
+
+__all__ = ["RetentionPolicy", "parse_nightly", "parse_size"]
+
+NIGHTLY_RE = re.compile(r"^(?P<extension>.*?)-?nightly\b.*?"
+                        r"\.(?P<date>\d{8})(?:\.(?P<time>\d{4}))?(?:\.|$)")
+
+def parse_nightly(name):
+    """ Return (key, timestamp) of a nightly name, or None.
+
+    The key groups nightlies of one extension and file type.
+    """
+    m = NIGHTLY_RE.search(name)
+    if not m:
+        return None
+    try:
+        ts = datetime.datetime.strptime(m.group("date") + (m.group("time") or "0000"),
+                                        "%Y%m%d%H%M")
+    except ValueError:
+        return None
+    ext = name.rsplit(".", 1)[-1]
+    return (m.group("extension"), ext), ts
+
+def parse_size(value):
+    """ Parse a byte count such as '500M' or '2G'. """
+    value = str(value).strip().upper().rstrip("B")
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+class RetentionPolicy(object):
+    def __init__(self, keep_last=None, max_age=None, max_bytes=None):
+        self.keep_last = keep_last
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+
+    def index(self, downloads):
+        """ Map each key to its nightlies as (timestamp, info), newest first. """
+        index = {}
+        for d in downloads:
+            parsed = parse_nightly(d.name)
+            if parsed:
+                key, ts = parsed
+                index.setdefault(key, []).append((ts, d))
+        for entries in index.values():
+            entries.sort(key=lambda e: e[0], reverse=True)
+        return index
+
+    def plan(self, downloads, now=None):
+        """ Return the downloads to delete, oldest first. """
+        now = now or datetime.datetime.now()
+        doomed = []
+        kept = []
+        for key, entries in self.index(downloads).items():
+            for i, (ts, d) in enumerate(entries):
+                if self.keep_last is not None and i >= self.keep_last:
+                    doomed.append((ts, d))
+                elif self.max_age is not None and now - ts > self.max_age:
+                    doomed.append((ts, d))
+                else:
+                    kept.append((ts, d))
+
+        if self.max_bytes is not None:
+            kept.sort(key=lambda e: e[0], reverse=True)
+            total = 0
+            for ts, d in kept:
+                total += getattr(d, "size", 0) or 0
+                if total > self.max_bytes:
+                    doomed.append((ts, d))
+
+        doomed.sort(key=lambda e: e[0])
+        return [d for ts, d in doomed]
@@ -0,0 +1,62 @@
+""" Order the entries of an XPI for fast installs and startup.
+
+The add-on manager reads install.rdf first, then chrome.manifest or
+bootstrap.js, default preferences and the icons; everything else is
+read as the extension uses it.  order() puts those files first, then
+the files of an optional access-order profile in profile order, then
+the rest grouped by directory, so related entries sit next to each
+other in the archive.
+
+A profile is a text file with one archive path per line, as recorded
+from a typical startup; blank lines and lines starting with '#' are
+skipped.
+
+Example:
+
+from xpilayout import order, read_profile
+names = order(names, read_profile("startup-profile.txt"))
+"""
+
+import fnmatch
+import posixpath
+
+__all__ = ["STARTUP_FILES", "order", "read_profile"]
+
+# archive path patterns, in the order they are read
+STARTUP_FILES = ["install.rdf",
+                 "chrome.manifest",
+                 "bootstrap.js",
+                 "harness-options.json",
+                 "defaults/preferences/*.js",
+                 "icon.png",
+                 "icon64.png",
+                 ]
+
+def read_profile(filename):
+    """ The archive paths of an access-order profile, in order. """
+    names = []
+    with open(filename) as fp:
+        for line in fp:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                names.append(line.lstrip("/"))
+    return names
+
+def _grouped(name):
+    d, base = posixpath.split(name)
+    return d.split("/"), base
+
+def order(names, profile=None):
+    """ Return the archive paths names, '/' separated, in startup order. """
+    rest = set(names)
+    ordered = []
+    for pattern in STARTUP_FILES:
+        for n in sorted(fnmatch.filter(rest, pattern)):
+            ordered.append(n)
+            rest.discard(n)
+    for n in profile or ():
+        if n in rest:
+            ordered.append(n)
+            rest.discard(n)
+    ordered.extend(sorted(rest, key=_grouped))
+    return ordered